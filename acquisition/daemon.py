@@ -0,0 +1,247 @@
+import logging
+import threading
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.connection import Client, Listener
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from . import sources
+
+MAGIC = 0x53504543  # 'SPEC'
+# ring header: magic, slot count, pixel count, sequence number of the last completed frame
+RING_HEADER_DTYPE = np.dtype([('magic', '<i8'), ('slots', '<i8'), ('pixel_count', '<i8'), ('last_seq', '<i8')])
+
+
+def _slot_dtype(pixel_count):
+    # seq is -1 while the slot is being written
+    return np.dtype([('seq', '<i8'), ('timestamp_ns', '<i8'), ('frame', '<f4', (pixel_count,))])
+
+
+class SharedRing:
+    '''
+    Ring of spectra in shared memory. Every slot carries a sequence number which is invalidated while
+    the slot gets rewritten, so readers can use frames in place and check afterwards that they were not overwritten.
+    Only the creating process writes, readers get read-only views
+    '''
+
+    def __init__(self, name, pixel_count=0, slots=64, create=False) -> None:
+        super().__init__()
+        if create:
+            size = RING_HEADER_DTYPE.itemsize + slots * _slot_dtype(pixel_count).itemsize
+            self._shm = SharedMemory(name, create=True, size=size)
+        else:
+            self._shm = _attach(name)
+        self.name = name
+        self.header = np.ndarray(1, RING_HEADER_DTYPE, self._shm.buf)[0]
+        if create:
+            self.header['magic'] = MAGIC
+            self.header['slots'] = slots
+            self.header['pixel_count'] = pixel_count
+            self.header['last_seq'] = -1
+        elif self.header['magic'] != MAGIC:
+            raise ValueError('%s is not a spectrum ring' % name)
+        self.slots = int(self.header['slots'])
+        self.pixel_count = int(self.header['pixel_count'])
+        self._slots = np.ndarray(self.slots, _slot_dtype(self.pixel_count), self._shm.buf, RING_HEADER_DTYPE.itemsize)
+        self._owner = create
+        if not create:
+            self._slots.flags.writeable = False
+
+    def last_seq(self):
+        return int(self.header['last_seq'])
+
+    def write(self, frame, timestamp_ns):
+        seq = self.last_seq() + 1
+        slot = self._slots[seq % self.slots]
+        slot['seq'] = -1
+        slot['frame'][:] = frame
+        slot['timestamp_ns'] = timestamp_ns
+        slot['seq'] = seq
+        self.header['last_seq'] = seq
+        return seq
+
+    # (timestamp, frame view) of frame seq or None if it's gone or not there yet.
+    # View points into the ring, check valid(seq) after using it
+    def read(self, seq):
+        slot = self._slots[seq % self.slots]
+        if slot['seq'] != seq:
+            return None
+        return int(slot['timestamp_ns']), slot['frame']
+
+    def valid(self, seq):
+        return self._slots[seq % self.slots]['seq'] == seq
+
+    def close(self):
+        self.header = None
+        self._slots = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def _attach(name):
+    try:
+        return SharedMemory(name, track=False)
+    except TypeError:
+        # before Python 3.13 attaching registers the segment with resource tracker, which would remove it on exit
+        shm = SharedMemory(name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+# spectra come out shorter with a readout configuration
+def _output_count(spec):
+    return spec.get_pixel_count() if spec.readout is None else spec.readout.output_count
+
+
+class AcquisitionDaemon:
+    '''
+    Owns a device and shares its spectra with local processes.
+    acquire_fn() is called in a loop on the acquisition thread and returns (N x pixel count batch, N timestamps ns),
+    frames go into a SharedRing named name. Empty batch means nothing was ready, next call follows after idle_interval.
+    Commands arrive over a local socket at address as (command, args) tuples, commands maps command names
+    to callables. Commands run one at a time and never in the middle of acquire_fn(), so device access stays serialised
+    '''
+    _log = None
+
+    def __init__(self, name, acquire_fn, pixel_count, commands=None, address=None, authkey=b'spectra', slots=64,
+                 idle_interval=0.005) -> None:
+        super().__init__()
+        self.idle_interval = idle_interval
+        self._authkey = authkey
+        self._log = logging.getLogger('AcquisitionDaemon')
+        self.ring = SharedRing(name, pixel_count, slots, create=True)
+        self._acquire_fn = acquire_fn
+        self.commands = dict(commands or {})
+        self.device_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._listener = Listener(address, authkey=authkey)
+        self.address = self._listener.address
+        self._threads = []
+
+    @classmethod
+    def for_qred(cls, spec, name, **kwargs):
+        return cls(name, sources.qred_continuous(spec), _output_count(spec), sources.qred_commands(spec), **kwargs)
+
+    @classmethod
+    def for_rock(cls, spec, name, integration_time, average_count=1, **kwargs):
+        capture = sources.rock_capture(spec, integration_time, average_count)
+        return cls(name, capture, _output_count(spec), sources.rock_commands(spec, capture), **kwargs)
+
+    def start(self):
+        for target, thread_name in ((self._acquire, 'Acquisition'), (self._serve, 'CommandServer')):
+            thread = threading.Thread(target=target, name=thread_name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        # unblock accept()
+        try:
+            Client(self.address, authkey=self._authkey).close()
+        except OSError:
+            pass
+        for thread in self._threads:
+            thread.join()
+        self._listener.close()
+        self.ring.close()
+
+    def _acquire(self):
+        while not self._stop.is_set():
+            try:
+                with self.device_lock:
+                    batch, timestamps = self._acquire_fn()
+            except Exception as e:
+                self._log.error('Acquisition failed: %s', e)
+                self._stop.wait(1)
+                continue
+            if not len(batch):
+                self._stop.wait(self.idle_interval)
+                continue
+            for frame, timestamp in zip(batch, timestamps):
+                self.ring.write(frame, timestamp)
+
+    def _serve(self):
+        while not self._stop.is_set():
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                continue
+            if self._stop.is_set():
+                conn.close()
+                return
+            threading.Thread(target=self._handle, args=(conn,), name='CommandClient', daemon=True).start()
+
+    def _handle(self, conn):
+        with conn:
+            while not self._stop.is_set():
+                try:
+                    command, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                if command == 'ring':
+                    conn.send(('ok', self.ring.name))
+                    continue
+                fn = self.commands.get(command)
+                if fn is None:
+                    conn.send(('error', 'Unknown command %s' % command))
+                    continue
+                try:
+                    with self.device_lock:
+                        result = fn(*args)
+                    conn.send(('ok', result))
+                except Exception as e:
+                    conn.send(('error', '%s: %s' % (e.__class__.__name__, e)))
+
+
+class DaemonError(Exception):
+    pass
+
+
+class SpectrumClient:
+    '''
+    Local process side of AcquisitionDaemon: maps the daemon's ring and sends commands.
+    next_frame() gives frames as read-only views into shared memory, no copies involved.
+    The daemon keeps writing while a view is in use and overwrites its slot once the ring wraps around,
+    so check ring.valid(seq) after using a frame (or copy it first) and drop results when it's False
+    '''
+
+    def __init__(self, address, authkey=b'spectra') -> None:
+        super().__init__()
+        self._conn = Client(address, authkey=authkey)
+        self.ring = SharedRing(self.command('ring'))
+        self.seq = self.ring.last_seq()
+
+    def command(self, command, *args):
+        self._conn.send((command, args))
+        status, result = self._conn.recv()
+        if status != 'ok':
+            raise DaemonError(result)
+        return result
+
+    # Wait for the frame after the last one returned, (seq, timestamp, frame view) or None on timeout.
+    # If the client fell behind by more than the ring size, it skips ahead to the oldest frame still available.
+    # The view is only valid as long as ring.valid(seq) is True, see class docstring
+    def next_frame(self, timeout=None, poll_interval=0.001):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            last = self.ring.last_seq()
+            if last > self.seq:
+                seq = max(self.seq + 1, last - self.ring.slots + 1)
+                entry = self.ring.read(seq)
+                # slot may have been taken over between the sequence check and reading the timestamp
+                if entry is not None and self.ring.valid(seq):
+                    self.seq = seq
+                    return seq, entry[0], entry[1]
+                self.seq = seq
+                continue
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            time.sleep(poll_interval)
+
+    def close(self):
+        self._conn.close()
+        self.ring.close()
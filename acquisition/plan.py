@@ -0,0 +1,303 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class Step:
+    '''
+    One point of a measurement plan: settings for device (e.g. exposure_ms=10, averaging=4, temperature=-5)
+    and the number of frames to take with them
+    '''
+
+    def __init__(self, device, frames=1, label=None, **settings) -> None:
+        super().__init__()
+        self.device = device
+        self.frames = frames
+        self.label = label
+        self.settings = settings
+
+    def __repr__(self):
+        return 'Step(%s, %s, frames=%d)' % (self.device, self.settings, self.frames)
+
+
+class PlanDevice:
+    '''
+    Adapter between plan steps and an instrument.
+    setting_costs holds the estimated time (s) of changing every setting, anything not listed counts as free.
+    apply() changes one setting, acquire() takes step.frames frames with the current settings
+    '''
+    setting_costs = {}
+    frame_overhead = 0.0  # seconds per frame on top of frame_time()
+
+    def __init__(self, name) -> None:
+        super().__init__()
+        self.name = name
+        self.settings = {}
+
+    def apply(self, name, value):
+        raise NotImplementedError
+
+    def acquire(self, step):
+        raise NotImplementedError
+
+    # seconds of signal integration per frame with the given settings
+    def frame_time(self, settings):
+        return 0.0
+
+    def cost(self, name):
+        return self.setting_costs.get(name, 0.0)
+
+    # settings of step that differ from current
+    def changes(self, settings, current=None):
+        current = self.settings if current is None else current
+        return {k: v for k, v in settings.items() if current.get(k) != v}
+
+    def estimate(self, step, current=None):
+        changes = self.changes(step.settings, current)
+        merged = dict(self.settings if current is None else current, **step.settings)
+        return sum(self.cost(k) for k in changes) + step.frames * (self.frame_time(merged) + self.frame_overhead)
+
+    # slow settings are applied first, so they are under way before the quick ones
+    def configure(self, settings):
+        changes = self.changes(settings)
+        for name in sorted(changes, key=self.cost, reverse=True):
+            self.apply(name, changes[name])
+            self.settings[name] = changes[name]
+
+
+class QredDevice(PlanDevice):
+    setting_costs = {'temperature': 120.0, 'exposure_ms': 0.005, 'averaging': 0.005}
+    frame_overhead = 0.002
+
+    def __init__(self, spec, name='qred', tolerance=0.1, hold_time=5.0, settle_timeout=600.0) -> None:
+        super().__init__(name)
+        self.spec = spec
+        self.tolerance = tolerance
+        self.hold_time = hold_time
+        self.settle_timeout = settle_timeout
+
+    def apply(self, name, value):
+        if name == 'temperature':
+            self.spec.settle_temperature(value, self.tolerance, self.hold_time, self.settle_timeout).result()
+        elif name == 'exposure_ms':
+            self.spec.set_exposure_time_ms(value)
+        elif name == 'averaging':
+            self.spec.set_averaging(value)
+        else:
+            raise ValueError('Unknown Qred setting %s' % name)
+
+    def frame_time(self, settings):
+        return settings.get('exposure_ms', 0.0) * settings.get('averaging', 1) / 1000
+
+    def acquire(self, step):
+        spectra = []
+        headers = []
+        timeout = step.frames * (self.frame_time(self.settings) + 1.0) + 5
+        self.spec.start_exposure(step.frames)
+        while sum(len(s) for s in spectra) < step.frames:
+            self.spec.wait_for_spectra(1, timeout)
+            s, h = self.spec.drain(max_count=step.frames - sum(len(s) for s in spectra))
+            spectra.append(s.copy())
+            headers.append(h.copy())
+        return np.concatenate(spectra), np.concatenate(headers)
+
+
+class RockDevice(PlanDevice):
+    # exposure and averaging go with every capture request, changing them costs nothing
+    frame_overhead = 0.5  # ASCII transfer at 115200 baud
+
+    def __init__(self, spec, name='rock') -> None:
+        super().__init__(name)
+        self.spec = spec
+
+    def apply(self, name, value):
+        if name not in ('exposure_ms', 'averaging'):
+            raise ValueError('Unknown Rock setting %s' % name)
+
+    def frame_time(self, settings):
+        return settings.get('exposure_ms', 0.0) * settings.get('averaging', 1) / 1000
+
+    def acquire(self, step):
+        from instrument.spectrometer.ibsen.rock.rock import CaptureType, OutputFormat
+        exposure = int(round(self.settings.get('exposure_ms', 1)))
+        averaging = self.settings.get('averaging', 1)
+        return np.array([self.spec.capture(CaptureType.LIGHT, exposure, averaging, OutputFormat.ASCII_W_SPACES)
+                         for _ in range(step.frames)], dtype=np.float64)
+
+
+class DmmDevice(PlanDevice):
+    setting_costs = {'function': 0.2, 'channel': 0.05}
+    frame_overhead = 0.05
+
+    def __init__(self, dmm, name='dmm') -> None:
+        super().__init__(name)
+        self.dmm = dmm
+
+    def apply(self, name, value):
+        if name == 'function':
+            self.dmm.set_measurement_type(value)
+        elif name != 'channel':
+            raise ValueError('Unknown DMM setting %s' % name)
+
+    def acquire(self, step):
+        channel = self.settings.get('channel')
+        if channel is None:
+            return np.array([self.dmm.read_value() for _ in range(step.frames)])
+        return np.array([self.dmm.read_channel(channel) for _ in range(step.frames)])
+
+
+class StepResult:
+    step = None
+    data = None  # output of PlanDevice.acquire(), or of process_fn if given
+    started_ns = 0  # host time.monotonic_ns() at start of acquisition
+    estimated = 0.0  # seconds, configuration and acquisition
+    configure_time = 0.0
+    acquire_time = 0.0
+
+    def __init__(self, step, data, started_ns, estimated, configure_time, acquire_time) -> None:
+        self.step = step
+        self.data = data
+        self.started_ns = started_ns
+        self.estimated = estimated
+        self.configure_time = configure_time
+        self.acquire_time = acquire_time
+
+    def actual(self):
+        return self.configure_time + self.acquire_time
+
+
+class PlanReport:
+    results = []  # StepResult in completion order, without data
+    sequential_estimate = 0.0  # seconds for the steps one after another in the given order
+    estimate = 0.0  # seconds for the reordered plan, devices in parallel
+    wall_time = 0.0
+
+    def __init__(self, results, sequential_estimate, estimate, wall_time) -> None:
+        self.results = results
+        self.sequential_estimate = sequential_estimate
+        self.estimate = estimate
+        self.wall_time = wall_time
+
+    def log(self, log):
+        for r in self.results:
+            log.info('%-40s estimated %8.3f s, actual %8.3f s (configure %.3f, acquire %.3f)',
+                     r.step.label or r.step, r.estimated, r.actual(), r.configure_time, r.acquire_time)
+        log.info('Sequential estimate %.1f s, plan estimate %.1f s, wall time %.1f s',
+                 self.sequential_estimate, self.estimate, self.wall_time)
+
+
+class PlanExecutor:
+    '''
+    Runs a list of Steps over several devices ({name: PlanDevice}).
+    Steps are reordered per device so expensive settings change least often: steps get sorted by their settings,
+    most expensive one outermost (TEC setpoint changes last, exposures grouped under it).
+    Every device works through its steps on its own thread, so one device can settle while another acquires.
+    Acquired data goes to process_fn(step, data) and sink(StepResult) on a separate processing thread,
+    which overlaps with the device reconfiguring for its next step
+    '''
+    _log = None
+
+    def __init__(self, devices, process_fn=None) -> None:
+        super().__init__()
+        self.devices = dict(devices)
+        self.process_fn = process_fn
+        self._log = logging.getLogger('PlanExecutor')
+
+    # {device name: [steps]} in execution order
+    def order(self, steps):
+        plan = {}
+        for step in steps:
+            if step.device not in self.devices:
+                raise ValueError('Unknown device %s' % step.device)
+            plan.setdefault(step.device, []).append(step)
+        for name, device_steps in plan.items():
+            plan[name] = sorted(device_steps, key=lambda s: self._sort_key(self.devices[name], s))
+        return plan
+
+    def _sort_key(self, device, step):
+        names = sorted(step.settings, key=lambda k: (-device.cost(k), k))
+        # None (setting left as is) sorts first, mixed types compare by their text
+        return tuple((name, step.settings[name] is not None, _comparable(step.settings[name])) for name in names)
+
+    # seconds for steps one after another in the given order, starting from current device settings
+    def sequential_estimate(self, steps):
+        current = {name: dict(d.settings) for name, d in self.devices.items()}
+        total = 0.0
+        for step in steps:
+            total += self.devices[step.device].estimate(step, current[step.device])
+            current[step.device].update(step.settings)
+        return total
+
+    # seconds for the ordered plan, devices running in parallel
+    def estimate(self, plan):
+        return max([self.sequential_estimate(steps) for steps in plan.values()] or [0.0])
+
+    def run(self, steps, sink=None, reorder=True):
+        steps = list(steps)
+        if reorder:
+            plan = self.order(steps)
+        else:
+            plan = {}
+            for step in steps:
+                plan.setdefault(step.device, []).append(step)
+        sequential = self.sequential_estimate(steps)
+        estimate = self.estimate(plan)
+        self._log.info('%d steps, estimated %.1f s (%.1f s in given order)', len(steps), estimate, sequential)
+        results = []
+        errors = []
+        lock = threading.Lock()
+        processing = ThreadPoolExecutor(max_workers=1, thread_name_prefix='PlanProcessing')
+        pending = []
+
+        def finish(result):
+            if self.process_fn is not None:
+                result.data = self.process_fn(result.step, result.data)
+            if sink is not None:
+                sink(result)
+            result.data = None
+
+        def run_device(name, device_steps):
+            device = self.devices[name]
+            for step in device_steps:
+                estimated = device.estimate(step)
+                try:
+                    start = time.perf_counter()
+                    device.configure(step.settings)
+                    configured = time.perf_counter()
+                    started_ns = time.monotonic_ns()
+                    data = device.acquire(step)
+                    done = time.perf_counter()
+                except Exception as e:
+                    self._log.error('%s failed on %s: %s', step, name, e)
+                    with lock:
+                        errors.append(e)
+                    return
+                result = StepResult(step, data, started_ns, estimated, configured - start, done - configured)
+                with lock:
+                    results.append(result)
+                    pending.append(processing.submit(finish, result))
+
+        wall = time.perf_counter()
+        threads = [threading.Thread(target=run_device, args=item, name='Plan-%s' % item[0], daemon=True)
+                   for item in plan.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for future in pending:
+            future.result()
+        processing.shutdown()
+        report = PlanReport(results, sequential, estimate, time.perf_counter() - wall)
+        report.log(self._log)
+        if errors:
+            raise errors[0]
+        return report
+
+
+def _comparable(value):
+    if isinstance(value, (int, float)):
+        return (0, value, '')
+    return (1, 0, str(value))
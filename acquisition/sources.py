@@ -0,0 +1,73 @@
+import time
+
+import numpy as np
+
+# Acquisition functions and command sets for AcquisitionDaemon.
+# Source functions return (N x pixel count batch, N host timestamps in ns), empty batch if nothing is ready
+
+
+def qred_continuous(spec):
+    state = {'running': False}
+
+    def acquire():
+        if not state['running']:
+            spec.start_exposure(continuous=True)
+            state['running'] = True
+        if spec.get_available_spectra_count() == 0:
+            return np.empty((0, spec.get_pixel_count()), dtype=np.float32), []
+        frames, headers = spec.drain()
+        # drain() buffers are reused, ring write copies the frames
+        return frames, headers['host_ns']
+    return acquire
+
+
+def qred_commands(spec):
+    # continuous mode has to be restarted with new exposure settings
+    def set_exposure_time_ms(value):
+        spec.set_exposure_time_ms(value)
+        spec.start_exposure(continuous=True)
+
+    return {
+        'get_serial_number': spec.get_serial_number,
+        'get_wavelength_mapping': spec.get_wavelength_mapping,
+        'get_exposure_time_ms': spec.get_exposure_time_ms,
+        'get_averaging': spec.get_averaging,
+        'get_sensor_temp': spec.get_sensor_temp,
+        'get_sink_temp': spec.get_sink_temp,
+        'get_tec_status': lambda: spec.get_tec_status().name,
+        'get_target_temp': spec.get_target_temp,
+        'set_target_temp': spec.set_target_temp,
+        'set_exposure_time_ms': set_exposure_time_ms,
+    }
+
+
+def rock_capture(spec, integration_time, average_count=1):
+    from instrument.spectrometer.ibsen.rock.rock import CaptureType, OutputFormat
+    settings = {'integration_time': integration_time, 'average_count': average_count}
+
+    def acquire():
+        spectrum = spec.capture(CaptureType.LIGHT, settings['integration_time'], settings['average_count'],
+                                OutputFormat.ASCII_W_SPACES)
+        return np.asarray([spectrum], dtype=np.float32), [time.monotonic_ns()]
+    acquire.settings = settings
+    return acquire
+
+
+# capture is the rock_capture() function of the daemon, its settings go with every capture request
+def rock_commands(spec, capture):
+    settings = capture.settings
+
+    def set_integration_time(value):
+        settings['integration_time'] = int(value)
+
+    def set_average_count(value):
+        settings['average_count'] = int(value)
+
+    return {
+        'get_serial_number': spec.get_serial_number,
+        'get_wavelength_mapping': spec.get_pixel_to_wavelength_mapping,
+        'get_integration_time': lambda: settings['integration_time'],
+        'set_integration_time': set_integration_time,
+        'get_average_count': lambda: settings['average_count'],
+        'set_average_count': set_average_count,
+    }
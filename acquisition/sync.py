@@ -0,0 +1,275 @@
+import bisect
+import logging
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+NEAREST = 'nearest'
+INTERPOLATE = 'interpolate'
+
+
+class InstrumentStream:
+    '''
+    Acquisition worker of one instrument. read_fn() is called in a loop on its own thread and returns
+    a sample, None if nothing was ready, or with batch set a (samples, timestamps ns) pair.
+    Single samples are stamped with host time.monotonic_ns() halfway through the read_fn() call.
+    Samples go to a bounded buffer, the oldest get dropped (and counted) when the consumer falls behind
+    '''
+    _log = None
+
+    def __init__(self, name, read_fn, maxlen=1024, batch=False, idle_interval=0.001) -> None:
+        super().__init__()
+        self.name = name
+        self._read_fn = read_fn
+        self.batch = batch
+        self.idle_interval = idle_interval
+        self.dropped = 0
+        self.count = 0
+        self._buffer = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._log = logging.getLogger('InstrumentStream')
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='Stream-%s' % self.name, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            before = time.monotonic_ns()
+            try:
+                result = self._read_fn()
+            except Exception as e:
+                self._log.error('Reading %s failed: %s', self.name, e)
+                self._stop.wait(1)
+                continue
+            if result is None:
+                self._stop.wait(self.idle_interval)
+                continue
+            if self.batch:
+                samples, timestamps = result
+                if not len(samples):
+                    self._stop.wait(self.idle_interval)
+                    continue
+                self.add(zip((int(t) for t in timestamps), samples))
+            else:
+                self.add([((before + time.monotonic_ns()) // 2, result)])
+
+    # [(timestamp ns, sample), ...] in time order
+    def add(self, samples):
+        with self._lock:
+            for item in samples:
+                if len(self._buffer) == self._buffer.maxlen:
+                    self.dropped += 1
+                self._buffer.append(item)
+                self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._buffer)
+
+    # drop samples up to timestamp_ns, except the last keep of them (for interpolation)
+    def discard_before(self, timestamp_ns, keep=1):
+        with self._lock:
+            while len(self._buffer) > keep and self._buffer[keep][0] <= timestamp_ns:
+                self._buffer.popleft()
+
+
+# workers for the supported instruments
+
+def qred_stream(spec, name='qred', **kwargs):
+    # drain() stamps frames with the start of exposure in host time if clock sync is enabled
+    def read():
+        if spec.get_available_spectra_count() == 0:
+            return None
+        spectra, headers = spec.drain()
+        return spectra.copy(), headers['host_ns'].copy()
+    return InstrumentStream(name, read, batch=True, **kwargs)
+
+
+def rock_stream(spec, integration_time, average_count=1, name='rock', **kwargs):
+    from instrument.spectrometer.ibsen.rock.rock import CaptureType, OutputFormat
+
+    # capture returns after exposure and transfer, stamp at the middle of the exposure
+    def read():
+        start = time.monotonic_ns()
+        spectrum = spec.capture(CaptureType.LIGHT, integration_time, average_count, OutputFormat.ASCII_W_SPACES)
+        return [np.asarray(spectrum, dtype=np.float64)], [start + integration_time * average_count * 500000]
+    return InstrumentStream(name, read, batch=True, **kwargs)
+
+
+def freedom_stream(spec, name='freedom', use_correction=True, **kwargs):
+    def read():
+        start = time.monotonic_ns()
+        spec.triggerExposure()
+        spectrum = spec.get_spectrum(use_correction)
+        return [np.asarray(spectrum, dtype=np.float64)], [start + int(spec.getExposureTimeInNs()) // 2]
+    return InstrumentStream(name, read, batch=True, **kwargs)
+
+
+def dmm_stream(dmm, channel=None, name='dmm', **kwargs):
+    if channel is None:
+        return InstrumentStream(name, dmm.read_value, **kwargs)
+    return InstrumentStream(name, lambda: dmm.read_channel(channel), **kwargs)
+
+
+class SkewStats:
+    '''
+    Time offsets of matched samples relative to the reference stream.
+    drift is the least squares slope of the offset over reference time, in ns per s (ppm * 1000)
+    '''
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.count = 0
+        self.missed = 0
+        self.max_abs_ns = 0
+        self._t0 = None
+        self._sums = np.zeros(5)  # t, s, t*t, t*s, s*s with t in s relative to the first sample
+
+    def update(self, timestamp_ns, skew_ns):
+        if self._t0 is None:
+            self._t0 = timestamp_ns
+        t = (timestamp_ns - self._t0) / 1e9
+        s = float(skew_ns)
+        self._sums += (t, s, t * t, t * s, s * s)
+        self.count += 1
+        self.max_abs_ns = max(self.max_abs_ns, abs(skew_ns))
+
+    def mean_ns(self):
+        return self._sums[1] / self.count if self.count else 0.0
+
+    def std_ns(self):
+        if self.count < 2:
+            return 0.0
+        mean = self.mean_ns()
+        return float(np.sqrt(max(self._sums[4] / self.count - mean * mean, 0.0)))
+
+    def drift_ns_per_s(self):
+        n = self.count
+        st, ss, stt, sts = self._sums[:4]
+        denominator = n * stt - st * st
+        if n < 2 or denominator <= 0:
+            return 0.0
+        return (n * sts - st * ss) / denominator
+
+
+class SyncRecord:
+    timestamp_ns = 0  # of the reference sample
+    values = {}  # {stream name: sample}, None where nothing matched within tolerance
+    skew_ns = {}  # {stream name: timestamp of the matched sample - timestamp_ns}
+
+    def __init__(self, timestamp_ns, values, skew_ns) -> None:
+        self.timestamp_ns = timestamp_ns
+        self.values = values
+        self.skew_ns = skew_ns
+
+
+class Synchronizer:
+    '''
+    Joins streams onto the samples of a reference stream. Every reference sample becomes a SyncRecord
+    with the nearest sample of each other stream (NEAREST) or a value linearly interpolated between
+    the samples around it (INTERPOLATE, numeric samples only). Matches further off than tolerance_ns
+    are left out. A reference sample is joined once all other streams have moved past it,
+    or after max_wait seconds. Skew and drift per stream are collected in stats
+    '''
+    _log = None
+
+    def __init__(self, reference, others, mode=NEAREST, tolerance_ns=50000000, max_wait=1.0) -> None:
+        super().__init__()
+        if mode not in (NEAREST, INTERPOLATE):
+            raise ValueError('Unknown join mode %s' % mode)
+        self.reference = reference
+        self.others = list(others)
+        self.mode = mode
+        self.tolerance_ns = tolerance_ns
+        self.max_wait = max_wait
+        self.stats = {s.name: SkewStats() for s in self.others}
+        self._stop = threading.Event()
+        self._thread = None
+        self._log = logging.getLogger('Synchronizer')
+
+    def start(self):
+        for stream in [self.reference] + self.others:
+            stream.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for stream in [self.reference] + self.others:
+            stream.stop()
+
+    # join whatever is ready, returns SyncRecords in reference order
+    def poll(self):
+        records = []
+        pending = self.reference.snapshot()
+        if not pending:
+            return records
+        snapshots = {s.name: s.snapshot() for s in self.others}
+        now = time.monotonic_ns()
+        for timestamp, value in pending:
+            waiting = [s for s in self.others if not snapshots[s.name] or snapshots[s.name][-1][0] < timestamp]
+            if waiting and now - timestamp < self.max_wait * 1e9:
+                break
+            self.reference.discard_before(timestamp, keep=0)
+            values = {}
+            skews = {}
+            for stream in self.others:
+                values[stream.name], skews[stream.name] = self._match(snapshots[stream.name], timestamp)
+                if skews[stream.name] is None:
+                    self.stats[stream.name].missed += 1
+                else:
+                    self.stats[stream.name].update(timestamp, skews[stream.name])
+            records.append(SyncRecord(timestamp, values, skews))
+            for stream in self.others:
+                stream.discard_before(timestamp - self.tolerance_ns)
+        return records
+
+    # (value, skew) of samples [(timestamp, value), ...] at timestamp, (None, None) if nothing within tolerance
+    def _match(self, samples, timestamp):
+        if not samples:
+            return None, None
+        times = [t for t, _ in samples]
+        i = bisect.bisect_left(times, timestamp)
+        if self.mode == INTERPOLATE and 0 < i < len(times):
+            (t0, v0), (t1, v1) = samples[i - 1], samples[i]
+            skew = min(timestamp - t0, t1 - timestamp)
+            if skew <= self.tolerance_ns and t1 > t0:
+                w = (timestamp - t0) / (t1 - t0)
+                return v0 + (v1 - v0) * w, skew
+        candidates = [j for j in (i - 1, i) if 0 <= j < len(times)]
+        j = min(candidates, key=lambda k: abs(times[k] - timestamp))
+        skew = times[j] - timestamp
+        if abs(skew) > self.tolerance_ns:
+            return None, None
+        return samples[j][1], skew
+
+    # join in the background, sink(record) for every record
+    def run(self, sink, interval=0.01):
+        def run():
+            while not self._stop.is_set():
+                for record in self.poll():
+                    sink(record)
+                self._stop.wait(interval)
+        self._thread = threading.Thread(target=run, name='Synchronizer', daemon=True)
+        self._thread.start()
+        return self
+
+    def report(self):
+        for stream in self.others:
+            stats = self.stats[stream.name]
+            self._log.info('%s: %d matched, %d missed, skew %.3f +/- %.3f ms (max %.3f ms), drift %.1f us/s, %d dropped',
+                           stream.name, stats.count, stats.missed, stats.mean_ns() / 1e6, stats.std_ns() / 1e6,
+                           stats.max_abs_ns / 1e6, stats.drift_ns_per_s() / 1e3,
+                           stream.dropped)
@@ -0,0 +1,53 @@
+import importlib
+import importlib.util
+
+
+class DriverInfo:
+    '''
+    Registry entry of a driver. Only names are stored, the driver module and its dependencies
+    get imported by load() when a device is actually needed
+    '''
+
+    def __init__(self, name, kind, module, class_name, requires=(), description='') -> None:
+        super().__init__()
+        self.name = name
+        self.kind = kind
+        self.module = module  # relative to this package
+        self.class_name = class_name
+        self.requires = requires  # third party modules the driver needs
+        self.description = description
+
+    # dependencies installed, checked without importing them
+    def available(self):
+        return all(importlib.util.find_spec(m) is not None for m in self.requires)
+
+    def load(self):
+        return getattr(importlib.import_module(self.module, __package__), self.class_name)
+
+
+DRIVERS = {d.name: d for d in (
+    DriverInfo('qred', 'spectrometer', '.spectrometer.broadcom.qred', 'Spectrometer', ('numpy', 'usb'),
+               'Broadcom Qred SWIR spectrometer over USB'),
+    DriverInfo('ibsen_rock', 'spectrometer', '.spectrometer.ibsen.rock.rock', 'Spectrometer', (),
+               'Ibsen Rock spectrometer, serial port functions supplied by the caller'),
+    DriverInfo('ibsen_rock_tec', 'tec', '.spectrometer.ibsen.rock.rock', 'TECController', (),
+               'Ibsen Rock TEC controller'),
+    DriverInfo('ibsen_freedom', 'spectrometer', '.spectrometer.ibsen.freedom.freedom', 'Spectrometer', (),
+               'Ibsen Freedom spectrometer, SPI functions supplied by the caller'),
+    DriverInfo('keythley2000', 'dmm', '.dmm.keythley2000.keythley2000', 'dmm', (),
+               'Keythley 2000 multimeter, GPIB controller supplied by the caller'),
+)}
+
+
+def list_drivers(kind=None):
+    return [d for d in DRIVERS.values() if kind is None or d.kind == kind]
+
+
+def get_driver(name):
+    if name not in DRIVERS:
+        raise ValueError('Unknown driver %s' % name)
+    return DRIVERS[name].load()
+
+
+def open_device(name, *args, **kwargs):
+    return get_driver(name)(*args, **kwargs)
@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import queue
+import threading
+
+import numpy as np
+
+META_FILE = 'meta.json'
+FRAMES_FILE = 'frames.bin'
+HEADERS_FILE = 'headers.bin'
+WAVELENGTHS_FILE = 'wavelengths.npy'
+
+# per frame fields every archive has, driver specific header fields can be appended,
+# e.g. extend_header_dtype(qred.SPECTRUM_HEADER_DTYPE)
+HEADER_FIELDS = [
+    ('host_time_ns', '<i8'),
+    ('exposure_ms', '<f8'),
+    ('temperature', '<f8'),
+]
+HEADER_DTYPE = np.dtype(HEADER_FIELDS)
+
+
+def extend_header_dtype(extra):
+    names = set(HEADER_DTYPE.names)
+    return np.dtype(HEADER_FIELDS + [f for f in np.dtype(extra).descr if f[0] not in names])
+
+
+class ArchiveWriter:
+    '''
+    Appends spectra to an archive directory: raw frames.bin (N x pixel count) and headers.bin
+    (structured records) plus meta.json holding the layout and number of committed frames.
+    append() only copies the data and queues it, a writer thread collects frames into chunks
+    of chunk_frames and writes them out, so acquisition does not wait for the disk.
+    Readers only see frames up to the count committed in meta.json
+    '''
+    _log = None
+
+    def __init__(self, path, pixel_count, wavelengths=None, frame_dtype=np.float32, header_dtype=HEADER_DTYPE,
+                 chunk_frames=64) -> None:
+        super().__init__()
+        self.path = path
+        self.pixel_count = pixel_count
+        self.frame_dtype = np.dtype(frame_dtype)
+        self.header_dtype = np.dtype(header_dtype)
+        self.chunk_frames = chunk_frames
+        self._log = logging.getLogger('ArchiveWriter')
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, META_FILE)):
+            raise ValueError('Archive %s already exists' % path)
+        if wavelengths is not None:
+            np.save(os.path.join(path, WAVELENGTHS_FILE), np.asarray(wavelengths, dtype=np.float64))
+        self.frame_count = 0
+        self._frames_file = open(os.path.join(path, FRAMES_FILE), 'ab')
+        self._headers_file = open(os.path.join(path, HEADERS_FILE), 'ab')
+        self._write_meta()
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='ArchiveWriter', daemon=True)
+        self._thread.start()
+
+    # frames: single spectrum or N x pixel count batch
+    # headers: structured array of N records, or per field values (scalar or length N), missing fields are zero
+    def append(self, frames, headers=None, **fields):
+        if self._error is not None:
+            raise self._error
+        frames = np.array(frames, dtype=self.frame_dtype, ndmin=2)
+        if frames.shape[1] != self.pixel_count:
+            raise ValueError('Expected %d pixels, got %d' % (self.pixel_count, frames.shape[1]))
+        records = np.zeros(len(frames), dtype=self.header_dtype)
+        if headers is not None:
+            headers = np.atleast_1d(headers)
+            for name in headers.dtype.names:
+                if name in records.dtype.names:
+                    records[name] = headers[name]
+        for name, value in fields.items():
+            records[name] = value
+        self._queue.put((frames, records))
+
+    # wait until everything appended so far is on disk
+    def flush(self):
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+            self._frames_file.close()
+            self._headers_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _run(self):
+        frames = []
+        records = []
+        buffered = 0
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, threading.Event):
+                try:
+                    self._write(frames, records)
+                finally:
+                    frames, records, buffered = [], [], 0
+                    item.set()
+                continue
+            frames.append(item[0])
+            records.append(item[1])
+            buffered += len(item[0])
+            if buffered >= self.chunk_frames:
+                self._write(frames, records)
+                frames, records, buffered = [], [], 0
+
+    def _write(self, frames, records):
+        if not frames or self._error is not None:
+            return
+        try:
+            self._frames_file.write(np.concatenate(frames).tobytes())
+            self._headers_file.write(np.concatenate(records).tobytes())
+            self._frames_file.flush()
+            self._headers_file.flush()
+            self.frame_count += sum(len(f) for f in frames)
+            self._write_meta()
+        except Exception as e:
+            # kept for flush() to raise, the writer thread goes on serving flush events
+            self._log.error('Writing archive %s failed: %s', self.path, e)
+            self._error = e
+
+    def _write_meta(self):
+        meta = {
+            'pixel_count': self.pixel_count,
+            'frame_dtype': self.frame_dtype.str,
+            'header_dtype': self.header_dtype.descr,
+            'frame_count': self.frame_count,
+        }
+        path = os.path.join(self.path, META_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(path + '.tmp', path)
+
+
+class SpectrumArchive:
+    '''
+    Read access to an archive written by ArchiveWriter, frames and headers are memory-mapped.
+    archive[i], archive[a:b] give frames, headers[...] the matching records,
+    time_slice() selects frames by host time (or any other monotonic header field).
+    refresh() picks up frames committed since opening
+    '''
+
+    def __init__(self, path) -> None:
+        super().__init__()
+        self.path = path
+        wl_path = os.path.join(path, WAVELENGTHS_FILE)
+        self.wavelengths = np.load(wl_path, mmap_mode='r') if os.path.exists(wl_path) else None
+        self.refresh()
+
+    def refresh(self):
+        with open(os.path.join(self.path, META_FILE)) as f:
+            meta = json.load(f)
+        self.pixel_count = meta['pixel_count']
+        self.frame_dtype = np.dtype(meta['frame_dtype'])
+        self.header_dtype = np.dtype([tuple(f) for f in meta['header_dtype']])
+        count = meta['frame_count']
+        if count == 0:
+            self.frames = np.empty((0, self.pixel_count), dtype=self.frame_dtype)
+            self.headers = np.empty(0, dtype=self.header_dtype)
+        else:
+            self.frames = np.memmap(os.path.join(self.path, FRAMES_FILE), self.frame_dtype, 'r',
+                                    shape=(count, self.pixel_count))
+            self.headers = np.memmap(os.path.join(self.path, HEADERS_FILE), self.header_dtype, 'r', shape=(count,))
+        return count
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, item):
+        return self.frames[item]
+
+    # slice of frames with start_ns <= field < end_ns
+    def time_slice(self, start_ns=None, end_ns=None, field='host_time_ns'):
+        times = self.headers[field]
+        first = 0 if start_ns is None else int(np.searchsorted(times, start_ns, 'left'))
+        last = len(times) if end_ns is None else int(np.searchsorted(times, end_ns, 'left'))
+        return slice(first, last)
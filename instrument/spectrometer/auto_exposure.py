@@ -0,0 +1,141 @@
+import logging
+
+import numpy as np
+
+
+class Roi:
+    # pixels [first, last) should peak at target fraction of saturation
+    def __init__(self, first, last, target=0.75) -> None:
+        self.first = first
+        self.last = last
+        self.target = target
+
+
+class AutoExposureResult:
+    exposure_ms = 0.0
+    peak_ratio = 0.0
+    iterations = 0
+    converged = False
+    spectrum = None
+
+    def __init__(self, exposure_ms, peak_ratio, iterations, converged, spectrum) -> None:
+        self.exposure_ms = exposure_ms
+        self.peak_ratio = peak_ratio
+        self.iterations = iterations
+        self.converged = converged
+        self.spectrum = spectrum
+
+
+class AutoExposure:
+    '''
+    Finds exposure time that brings the spectrum peak to a target fraction of saturation.
+    Signal is assumed linear in exposure above the offset, so next exposure is predicted from
+    the current peak level directly instead of stepping. Saturated captures carry no level information,
+    exposure is cut by saturated_step then.
+
+    capture_fn(exposure_ms) has to set the exposure, capture and return (spectrum, saturation level or None).
+    With ROIs given, every ROI is brought to (at most) its own target, the most demanding one decides.
+    Last good exposure per scene is cached, so a repeated run with the same scene and no start_ms starts from it.
+    '''
+    _log = None
+
+    def __init__(self, capture_fn, min_ms, max_ms, saturation, target=0.75, tolerance=0.1,
+                 rois=None, offset=0.0, max_iterations=6, saturated_step=0.25) -> None:
+        super().__init__()
+        if not 0 < target < 1:
+            raise ValueError('Target level has to be between 0 and 1')
+        self._capture_fn = capture_fn
+        self.min_ms = min_ms
+        self.max_ms = max_ms
+        self.saturation = saturation
+        self.target = target
+        self.tolerance = tolerance
+        self.rois = rois
+        self.offset = offset
+        self.max_iterations = max_iterations
+        self.saturated_step = saturated_step
+        self.scene_cache = {}
+        self._log = logging.getLogger('AutoExposure')
+
+    def run(self, start_ms=None, scene=None):
+        # explicit start wins, the cache is only used for named scenes
+        exposure = start_ms
+        if exposure is None and scene is not None:
+            exposure = self.scene_cache.get(scene)
+        if exposure is None:
+            exposure = np.sqrt(self.min_ms * self.max_ms) if self.min_ms > 0 else self.max_ms / 100
+        exposure = self._clip(exposure)
+        spectrum = None
+        ratio = 0.0
+        for iteration in range(1, self.max_iterations + 1):
+            spectrum, saturation = self._capture_fn(exposure)
+            saturation = saturation or self.saturation
+            if saturation is None:
+                raise ValueError('Saturation level unknown')
+            spectrum = np.asarray(spectrum, dtype=np.float64)
+            next_exposure, ratio, done = self._predict(exposure, spectrum, saturation)
+            self._log.debug('Exposure %.3f ms: peak at %.3f of saturation, next %.3f ms', exposure, ratio, next_exposure)
+            # also done when limited by exposure range and nothing more can be gained
+            if done or next_exposure == exposure:
+                if done and scene is not None:
+                    self.scene_cache[scene] = exposure
+                return AutoExposureResult(exposure, ratio, iteration, done, spectrum)
+            exposure = next_exposure
+        self._log.warning('Auto exposure did not converge in %d captures', self.max_iterations)
+        return AutoExposureResult(exposure, ratio, self.max_iterations, False, spectrum)
+
+    def _predict(self, exposure, spectrum, saturation):
+        rois = self.rois or [Roi(0, len(spectrum), self.target)]
+        full_scale = saturation - self.offset
+        scales = []
+        ratios = []
+        blind = False
+        for roi in rois:
+            peak = spectrum[roi.first:roi.last].max() - self.offset
+            ratios.append(peak / full_scale)
+            if peak >= 0.99 * full_scale:
+                # real level unknown, back off hard
+                scales.append(self.saturated_step)
+                blind = True
+            elif peak <= 0:
+                scales.append(10.0)
+                blind = True
+            else:
+                scales.append(roi.target / ratios[-1])
+        # ROI needing the shortest exposure decides, the others stay below their targets
+        scale = min(scales)
+        done = not blind and abs(scale - 1) <= self.tolerance
+        return self._clip(exposure * scale), max(ratios), done
+
+    def _clip(self, exposure):
+        return float(min(self.max_ms, max(self.min_ms, exposure)))
+
+
+# capture functions for the supported drivers
+
+def for_qred(spec, **kwargs):
+    def capture(exposure_ms):
+        spec.set_exposure_time_ms(exposure_ms)
+        spec.start_exposure()
+        spec.wait_for_spectra(1, timeout=exposure_ms / 1000 * spec.get_averaging() + 5)
+        s = spec.get_spectrum()
+        return s.amplitudes, s.header.saturation_value if s.header.saturation_value > 0 else None
+    return AutoExposure(capture, spec.get_exposure_time_min_us() / 1000, spec.get_exposure_time_max_us() / 1000,
+                        kwargs.pop('saturation', None), **kwargs)
+
+
+# Rock and Freedom do not report limits or saturation level, these have to be given
+def for_rock(spec, min_ms, max_ms, saturation, **kwargs):
+    from .ibsen.rock.rock import CaptureType, OutputFormat
+
+    def capture(exposure_ms):
+        return spec.capture(CaptureType.LIGHT, int(round(exposure_ms)), 1, OutputFormat.ASCII_W_SPACES), None
+    return AutoExposure(capture, min_ms, max_ms, saturation, **kwargs)
+
+
+def for_freedom(spec, min_ms, max_ms, saturation, **kwargs):
+    def capture(exposure_ms):
+        spec.setExposureTimeInMs(exposure_ms)
+        spec.triggerExposure()
+        return spec.get_spectrum(use_correction=False), None
+    return AutoExposure(capture, min_ms, max_ms, saturation, **kwargs)
@@ -1,15 +1,45 @@
 import logging
-import usb.core
-import usb.util
-from enum import Enum
+from array import array
+from enum import Enum, IntFlag
+
+import numpy as np
 
 import struct
 
 import time
 
+from ..pixel_correction import PixelMap
+from ..readout import ReadoutConfig
+from ..tec_settle import SettleMonitor
+from .qred_clock import DeviceClock
+
+usb = None  # pyusb, imported on first device access by _import_usb()
+
 VENDOR_ID = 0x276e
 PRODUCT_ID = 0x0209
 
+SPECTRUM_HEADER_SIZE = 48
+# same layout as Spectrum.SpectrumHeader.parse_bytes(), for decoding headers in bulk
+SPECTRUM_HEADER_DTYPE = np.dtype([
+	('exposure_time', '<i4'),
+	('averaging', '<i4'),
+	('timestamp', '<u4'),
+	('load_level', '<f4'),
+	('temperature', '<f4'),
+	('pixel_count', '<u2'),
+	('pixel_format', '<u2'),
+	('applied_processing', '<u2'),
+	('unit', '<u2'),
+	('spectrum_dropped', '<i4'),
+	('saturation_value', '<f4'),
+	('average_offset', '<f4'),
+	('average_dark', '<f4'),
+	('noise_level', '<f4'),
+])
+# drain() records: device header followed by host_ns, the start of exposure in host time.monotonic_ns()
+# with clock sync enabled, otherwise the host time the spectrum was read
+DRAIN_HEADER_DTYPE = np.dtype(SPECTRUM_HEADER_DTYPE.descr + [('host_ns', '<i8')])
+
 class MsgType(Enum):
 	COMMAND = 0x00
 	PARAMETER = 0x01
@@ -110,6 +140,19 @@ class MsgDeviceParameter(Enum):
 	ANALOG_OUT = 0x0E
 	TEMP_LIMIT_SINK = 0x0F # float 'C value
 
+# PROCESSING_STEPS parameter and SpectrumHeader.applied_processing bits.
+# Assigned in the order of the firmware processing chain, not verified against every firmware version
+class ProcessingSteps(IntFlag):
+	NONE = 0x00
+	ADJUST_OFFSET = 0x01
+	CORRECT_NONLINEARITY = 0x02
+	REMOVE_BAD_PIXELS = 0x04
+	SUBTRACT_DARK = 0x08
+	REMOVE_TEMP_BAD_PIXELS = 0x10
+	COMPENSATE_STRAY_LIGHT = 0x20
+	NORMALIZE_EXPOSURE_TIME = 0x40
+	CALIBRATE_SENSITIVITY = 0x80
+
 class MsgReturnCode(Enum):
 	OK = 0x00
 	UNKNOWN_COMMAND = 0x01
@@ -122,6 +165,101 @@ class MsgReturnCode(Enum):
 	INTERNAL_ERROR = 0x08
 	UNKNOWN_BOOTLOADER_COMMAND = 0x09
 
+class QredError(Exception):
+	return_code = None
+
+	def __init__(self, message, request=None) -> None:
+		super().__init__(message)
+		self.request = request
+
+class ResponseTimeoutError(QredError):
+	pass
+
+class ShortResponseError(QredError):
+	pass
+
+# return code not in MsgReturnCode, most likely stale or misaligned data
+class MalformedResponseError(QredError):
+	pass
+
+class UnknownCommandError(QredError):
+	return_code = MsgReturnCode.UNKNOWN_COMMAND
+
+class InvalidParameterError(QredError):
+	return_code = MsgReturnCode.INVALID_PARAMETER
+
+class MissingParameterError(QredError):
+	return_code = MsgReturnCode.MISSING_PARAMETER
+
+class InvalidOperationError(QredError):
+	return_code = MsgReturnCode.INVALID_OPERATION
+
+class NotSupportedError(QredError):
+	return_code = MsgReturnCode.NOT_SUPPORTED
+
+class InvalidPasscodeError(QredError):
+	return_code = MsgReturnCode.INVALID_PASSCODE
+
+class CommunicationError(QredError):
+	return_code = MsgReturnCode.COMMUNICATION_ERROR
+
+class InternalError(QredError):
+	return_code = MsgReturnCode.INTERNAL_ERROR
+
+class UnknownBootloaderCommandError(QredError):
+	return_code = MsgReturnCode.UNKNOWN_BOOTLOADER_COMMAND
+
+RETURN_CODE_ERRORS = {cls.return_code: cls for cls in (UnknownCommandError, InvalidParameterError,
+	MissingParameterError, InvalidOperationError, NotSupportedError, InvalidPasscodeError, CommunicationError,
+	InternalError, UnknownBootloaderCommandError)}
+
+class RetryPolicy:
+	'''
+	How requests get retried after a timeout, a short or garbled response or a transient device error.
+	First retry follows after initial_delay, every further one waits backoff times longer, up to max_delay.
+	Before each retry stale data is drained from the IN endpoint, reads time out after drain_timeout_ms
+	'''
+
+	def __init__(self, max_attempts=4, initial_delay=0.002, backoff=4.0, max_delay=0.2, drain_timeout_ms=5,
+			retryable=(ResponseTimeoutError, ShortResponseError, MalformedResponseError, CommunicationError)) -> None:
+		super().__init__()
+		self.max_attempts = max_attempts
+		self.initial_delay = initial_delay
+		self.backoff = backoff
+		self.max_delay = max_delay
+		self.drain_timeout_ms = drain_timeout_ms
+		self.retryable = tuple(retryable)
+
+	def is_retryable(self, error):
+		return isinstance(error, self.retryable)
+
+	# wait before retry number attempt (1 for the first retry)
+	def delay(self, attempt):
+		return min(self.max_delay, self.initial_delay * self.backoff ** (attempt - 1))
+
+class RetryStats:
+	'''
+	Retry counters of one device. reasons counts retries by exception class name,
+	recovered counts requests which succeeded after retrying, failed the ones given up on
+	'''
+
+	def __init__(self) -> None:
+		super().__init__()
+		self.retries = 0
+		self.recovered = 0
+		self.failed = 0
+		self.drained_bytes = 0
+		self.reasons = {}
+
+	def add_retry(self, error):
+		self.retries += 1
+		name = error.__class__.__name__
+		self.reasons[name] = self.reasons.get(name, 0) + 1
+
+	def as_dict(self):
+		return {'retries': self.retries, 'recovered': self.recovered, 'failed': self.failed,
+			'drained_bytes': self.drained_bytes, 'reasons': dict(self.reasons)}
+
 class TECStatus(Enum):
 	DISABLED = 0x00
 	SETPOINT_REACHED = 0x01
@@ -143,15 +281,49 @@ class Spectrometer:
 	_exp_time_max = 0
 	_averaging_min = 0
 	_averaging_max = 0
-
-	def __init__(self) -> None:
+	_rx_buffer = None
+	_rx_chunk = None
+	_packet_size = 512
+	_drain_spectra = None
+	_drain_headers = None
+	_pixel_map = None
+	_serial_number = None
+	_readout_wavelengths = None
+	retry_policy = RetryPolicy()
+	retry_stats = None
+	readout = None  # ReadoutConfig applied at readout, None for full frames
+	clock = None
+	clock_sync_interval = 10.0
+
+	# with neither argument given, binds the first Qred found on the bus
+	# serial_number selects a specific unit (see enumerate_devices()), usb_device binds an already found one
+	# retry_policy replaces the default RetryPolicy for this unit
+	def __init__(self, serial_number=None, usb_device=None, retry_policy=None) -> None:
 		super().__init__()
 		self.log = logging.getLogger('Qred')
-		self._dev = usb.core.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID)
-		if self._dev is None:
-			self.log.error('Could not find Qred device')
+		_import_usb()
+		if retry_policy is not None:
+			self.retry_policy = retry_policy
+		if usb_device is None:
+			if serial_number is None:
+				usb_device = usb.core.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID)
+			else:
+				usb_device = enumerate_devices().get(serial_number)
+		if usb_device is None:
+			self.log.error('Could not find Qred device %s', serial_number or '')
 			raise ValueError('Device not found')
-			return
+		self._open(usb_device)
+		_bound_devices[_device_key(usb_device)] = self
+		self.get_pixel_count()
+		self.get_wavelength_mapping()
+		self.get_exposure_time_min_us()
+		self.get_exposure_time_max_us()
+		self.get_averaging_min()
+		self.get_averaging_max()
+
+	def _open(self, usb_device):
+		self._dev = usb_device
+		self.retry_stats = RetryStats()
 		self._dev.set_configuration()
 		cfg = self._dev.get_active_configuration()
 		comms_interface = cfg[(0, 0)]
@@ -172,18 +344,14 @@ class Spectrometer:
 					usb.util.endpoint_direction(e.bEndpointAddress) == \
 					usb.util.ENDPOINT_IN)
 		self._send_init()
-		self.get_pixel_count()
-		self.get_wavelength_mapping()
-		self.get_exposure_time_min_us()
-		self.get_exposure_time_max_us()
-		self.get_averaging_min()
-		self.get_averaging_max()
 
 	def get_device_id(self):
 		return self._read_and_unpack_int_prop(MsgDevicePropertyRequest.DEVICE_ID)
 
 	def get_serial_number(self):
-		return self._read_and_unpack_string_prop(MsgDevicePropertyRequest.SERIAL_NO)
+		if self._serial_number is None:
+			self._serial_number = self._read_and_unpack_string_prop(MsgDevicePropertyRequest.SERIAL_NO)
+		return self._serial_number
 
 	def get_manufacturer(self):
 		return self._read_and_unpack_string_prop(MsgDevicePropertyRequest.MANUFACTURER)
@@ -205,8 +373,58 @@ class Spectrometer:
 	def get_pixel_count(self):
 		if self._pixel_count == 0:
 			self._pixel_count = self._read_and_unpack_int_prop(MsgDevicePropertyRequest.PIXEL_COUNT)
+			self._alloc_rx_buffers()
 		return self._pixel_count
 
+	# binning and first optical pixel are fixed in firmware, see set_readout() for host side ROI and binning
+	def get_pixels_per_bin(self):
+		return 1 << self._read_and_unpack_int_prop(MsgDevicePropertyRequest.PIXELS_PER_BIN_EXPONENT)
+
+	def get_real_pixel_first(self):
+		return self._read_and_unpack_int_prop(MsgDevicePropertyRequest.REAL_PIXEL_FIRST)
+
+	# Keep only pixels [first, last) and combine binning adjacent pixels, see ReadoutConfig.
+	# Applied directly on the receive buffer by get_spectrum() and drain(), called without arguments goes back to full frames
+	def set_readout(self, first=0, last=None, binning=1, average=False):
+		readout = ReadoutConfig(self.get_pixel_count(), first, last, binning, average)
+		self.readout = None if readout.is_full_frame() else readout
+		self._readout_wavelengths = None
+		self._drain_spectra = None
+		return readout
+
+	# wavelengths matching the pixels of spectra as returned with the current readout configuration
+	def get_readout_wavelengths(self):
+		if self.readout is None:
+			return self.get_wavelength_mapping()
+		if self._readout_wavelengths is None:
+			self._readout_wavelengths = tuple(self.readout.wavelengths(self.get_wavelength_mapping()))
+		return self._readout_wavelengths
+
+	# BAD_PIXELSn properties are read as lists of int32 pixel indices, negative ones mark unused slots
+	def get_bad_pixels(self):
+		bad_pixels = []
+		for prop in (MsgDevicePropertyRequest.BAD_PIXELS0, MsgDevicePropertyRequest.BAD_PIXELS1,
+				MsgDevicePropertyRequest.BAD_PIXELS2, MsgDevicePropertyRequest.BAD_PIXELS3):
+			raw = self._read_property(prop)
+			bad_pixels.extend(p for p in struct.unpack('<%di' % (len(raw) // 4), raw[:len(raw) // 4 * 4]) if p >= 0)
+		return bad_pixels
+
+	def get_dark_pixels(self):
+		first = self._read_and_unpack_int_prop(MsgDevicePropertyRequest.DARK_PIXEL_FIRST)
+		count = self._read_and_unpack_int_prop(MsgDevicePropertyRequest.DARK_PIXEL_COUNT)
+		return range(first, first + count)
+
+	def get_offset_pixels(self):
+		first = self._read_and_unpack_int_prop(MsgDevicePropertyRequest.OFFSET_PIXEL_FIRST)
+		count = self._read_and_unpack_int_prop(MsgDevicePropertyRequest.OFFSET_PIXEL_COUNT)
+		return range(first, first + count)
+
+	# bad, dark and offset pixel sets read once from the device, see PixelMap for batch correction
+	def get_pixel_map(self):
+		if self._pixel_map is None:
+			self._pixel_map = PixelMap(self.get_pixel_count(), self.get_bad_pixels(), self.get_dark_pixels(), self.get_offset_pixels())
+		return self._pixel_map
+
 	def get_exposure_time_ms(self):
 		return self.get_exposure_time_us() / 1000
 
@@ -224,7 +442,7 @@ class Spectrometer:
 		return self._exp_time_max
 
 	def set_exposure_time_ms(self, value):
-		et_us = value * 1000
+		et_us = int(round(value * 1000))
 		if et_us > self._exp_time_max:
 			self.log.error('Exposure time of %d us is larger than allowed maximum of %d us', et_us, self._exp_time_max)
 			raise ValueError('New exposure time too large')
@@ -233,9 +451,22 @@ class Spectrometer:
 			raise ValueError('New exposure time too small')
 		self._write_int_to_reg(format_message(MsgType.PARAMETER, MsgKind.MSG_SET, MsgDeviceParameter.EXPOSURE_TIME), et_us)
 
+	def get_processing_steps(self):
+		return ProcessingSteps(self._read_and_unpack_int_param(MsgDeviceParameter.PROCESSING_STEPS))
+
+	# steps the firmware applies to every following spectrum, see ProcessingSplit for sharing them with the host
+	def set_processing_steps(self, steps: ProcessingSteps):
+		self._write_int_param(MsgDeviceParameter.PROCESSING_STEPS, int(steps))
+
 	def get_averaging(self):
 		return self._read_and_unpack_int_param(MsgDeviceParameter.AVERAGING, msg_kind=MsgKind.MSG_GET)
 
+	def set_averaging(self, value):
+		if not self.get_averaging_min() <= value <= self.get_averaging_max():
+			self.log.error('Averaging of %d outside allowed range %d - %d', value, self._averaging_min, self._averaging_max)
+			raise ValueError('Averaging out of range')
+		self._write_int_param(MsgDeviceParameter.AVERAGING, int(value))
+
 	def get_averaging_min(self):
 		if self._averaging_min == 0:
 			self._averaging_min = self._read_and_unpack_int_param(MsgDeviceParameter.AVERAGING, msg_kind=MsgKind.MSG_MIN)
@@ -269,6 +500,82 @@ class Spectrometer:
 			self._wavelengths = struct.unpack('<%df' %self.get_pixel_count(), raw_data)
 		return self._wavelengths
 
+	def get_page_count(self, data_type: MsgBulkDataType):
+		if data_type not in PAGE_COUNT_PROPERTIES:
+			raise ValueError('%s is not paged data' % data_type.name)
+		return self._read_and_unpack_int_prop(PAGE_COUNT_PROPERTIES[data_type])
+
+	# Read all pages of CAL_DATA or USER_DATA. Requests are pipelined, up to window pages are requested
+	# before their responses get read, so the transfer is not bound by round trip latency.
+	# Contents are cached per serial number for the lifetime of the process, use_cache=False forces a reread
+	def read_paged_data(self, data_type: MsgBulkDataType, use_cache=True, window=4):
+		key = (self.get_serial_number(), data_type)
+		if use_cache and key in _paged_data_cache:
+			return b''.join(_paged_data_cache[key])
+		page_count = self.get_page_count(data_type)
+		reg = format_message(MsgType.DATA, MsgKind.MSG_GET, data_type)
+		# a failed pipelined read is restarted as a whole
+		pages = self._retry(reg, lambda: self._read_pages(data_type, range(page_count), window))
+		_paged_data_cache[key] = pages
+		return b''.join(pages)
+
+	# Write CAL_DATA or USER_DATA, only pages differing from the (cached) device contents get written.
+	# Written pages are read back for verification. Returns number of pages written
+	def write_paged_data(self, data_type: MsgBulkDataType, data, window=4):
+		key = (self.get_serial_number(), data_type)
+		self.read_paged_data(data_type, window=window)
+		pages = _paged_data_cache[key]
+		page_size = len(pages[0]) if pages else 0
+		if len(data) > page_size * len(pages):
+			raise ValueError('%d bytes do not fit into %d pages of %d bytes' % (len(data), len(pages), page_size))
+		new_pages = list(pages)
+		for i in range(len(pages)):
+			chunk = bytes(data[i * page_size:(i + 1) * page_size])
+			new_pages[i] = chunk + pages[i][len(chunk):]
+		changed = [i for i in range(len(pages)) if new_pages[i] != pages[i]]
+		reg = format_message(MsgType.DATA, MsgKind.MSG_SET, data_type)
+		for i in changed:
+			self._write_bus(struct.pack('<II', reg, i) + new_pages[i])
+		# drop cached contents until verified, device state is unknown otherwise
+		del _paged_data_cache[key]
+		readback = self._read_pages(data_type, changed, window)
+		for i, page in zip(changed, readback):
+			if page != new_pages[i]:
+				self.log.error('Page %d of %s failed verification', i, data_type.name)
+				raise ValueError('Paged data verification failed')
+		_paged_data_cache[key] = new_pages
+		return len(changed)
+
+	def get_calibration_data(self, use_cache=True):
+		return self.read_paged_data(MsgBulkDataType.CAL_DATA, use_cache)
+
+	def set_calibration_data(self, data):
+		return self.write_paged_data(MsgBulkDataType.CAL_DATA, data)
+
+	def get_user_data(self, use_cache=True):
+		return self.read_paged_data(MsgBulkDataType.USER_DATA, use_cache)
+
+	def set_user_data(self, data):
+		return self.write_paged_data(MsgBulkDataType.USER_DATA, data)
+
+	# page is requested by appending its index to the bulk data request
+	def _read_pages(self, data_type, page_numbers, window):
+		reg = format_message(MsgType.DATA, MsgKind.MSG_GET, data_type)
+		page_numbers = list(page_numbers)
+		pages = []
+		sent = 0
+		# responses carry no page address, they come back in request order
+		for _ in page_numbers:
+			while sent < len(page_numbers) and sent - len(pages) < window:
+				self._write_bus(struct.pack('<II', reg, page_numbers[sent]))
+				sent += 1
+			resp = self._read_bus()
+			check_response(reg, resp, len(resp))
+			pages.append(bytes(resp[4:]))
+		if pages and any(len(p) != len(pages[0]) for p in pages):
+			raise ValueError('Inconsistent page sizes in %s' % data_type.name)
+		return pages
+
 	def get_cooling_current(self):
 		return unpack_float(self._read_value(MsgMeasurementValueRequest.VAL_COOLING_CURRENT))
 
@@ -289,6 +596,43 @@ class Spectrometer:
 		self.log.info("Setting temperature to %3.6f", temp)
 		return self._write_float_to_reg(format_message(MsgType.PARAMETER, MsgKind.MSG_SET, MsgDeviceParameter.TEMP_TARGET), temp)
 
+	# Sets the new target (if given) and returns a Future resolving once sensor temperature stays
+	# within +/-tolerance 'C of the target for hold_time seconds.
+	# UNABLE_TO_REACH and SINK_TOO_HOT statuses fail the future with TECSettleError
+	def settle_temperature(self, setpoint=None, tolerance=0.1, hold_time=5.0, timeout=600.0, callback=None):
+		if setpoint is not None:
+			self.set_target_temp(setpoint)
+		else:
+			setpoint = self.get_target_temp()
+		monitor = SettleMonitor(self.get_sensor_temp, setpoint, tolerance, hold_time, timeout,
+			read_status_fn=self.get_tec_status,
+			fault_states=(TECStatus.UNABLE_TO_REACH, TECStatus.SINK_TOO_HOT),
+			callback=callback, name='QredTEC')
+		return monitor.start()
+
+	def get_systick(self):
+		return unpack_int(self._read_value(MsgMeasurementValueRequest.VAL_SYSTICK))
+
+	# Start relating device ticks to host monotonic time. Clock gets resampled every interval seconds
+	# during spectrum readout (get_spectrum() and drain()), which stamp spectra with the start of exposure in host time
+	def enable_clock_sync(self, interval=10.0, window=32, initial_samples=4):
+		self.clock = DeviceClock(window)
+		self.clock_sync_interval = interval
+		for _ in range(initial_samples):
+			self.sync_clock()
+		return self.clock
+
+	def sync_clock(self):
+		before_ns = time.monotonic_ns()
+		ticks = self.get_systick()
+		after_ns = time.monotonic_ns()
+		self.clock.add_sample(ticks, before_ns, after_ns)
+
+	# resample the device clock once clock_sync_interval has passed since the last sample
+	def _update_clock(self):
+		if time.monotonic_ns() - self.clock.last_sync_ns > self.clock_sync_interval * 1e9:
+			self.sync_clock()
+
 	def get_available_spectra_count(self):
 		return unpack_int(self._read_value(MsgMeasurementValueRequest.VAL_STATUS)) >> 8
 
@@ -299,14 +643,173 @@ class Spectrometer:
 			count = -1
 		self._write_int_to_reg(format_message(MsgType.COMMAND, MsgKind.MSG_GET, MsgCommand.CMD_START_EXPOSURE), count)
 
+	def stop_exposure(self):
+		self._write_register(format_message(MsgType.COMMAND, MsgKind.MSG_GET, MsgCommand.CMD_STOP_EXPOSURE))
+
+	# Trigger parameters are passed through as raw values, their encoding is firmware specific.
+	# Delay and pulse period are in us like EXPOSURE_TIME
+	def get_trigger_config(self):
+		return self._read_and_unpack_int_param(MsgDeviceParameter.CONFIG_TRIGGER)
+
+	def set_trigger_config(self, value):
+		self._write_int_param(MsgDeviceParameter.CONFIG_TRIGGER, value)
+
+	def get_trigger_delay_us(self):
+		return self._read_and_unpack_int_param(MsgDeviceParameter.TRIGGER_DELAY)
+
+	def set_trigger_delay_us(self, value):
+		self._write_int_param(MsgDeviceParameter.TRIGGER_DELAY, int(round(value)))
+
+	def get_external_trigger_enabled(self):
+		return self._read_and_unpack_int_param(MsgDeviceParameter.TRIGGER_ENABLE_EXTERNAL) != 0
+
+	def set_external_trigger_enabled(self, enabled):
+		self._write_int_param(MsgDeviceParameter.TRIGGER_ENABLE_EXTERNAL, 1 if enabled else 0)
+
+	def get_pulse_period_us(self):
+		return self._read_and_unpack_int_param(MsgDeviceParameter.PULSE_PERIOD)
+
+	def set_pulse_period_us(self, value):
+		self._write_int_param(MsgDeviceParameter.PULSE_PERIOD, int(round(value)))
+
+	def get_io_config(self):
+		return self._read_and_unpack_int_param(MsgDeviceParameter.CONFIG_IO)
+
+	def set_io_config(self, value):
+		self._write_int_param(MsgDeviceParameter.CONFIG_IO, value)
+
+	# Set up exposures to be started by the external trigger input (external=True) or by the device's own
+	# pulse generator (period_us), after delay_us. Arguments left as None keep their current device setting
+	def configure_trigger(self, external=True, delay_us=None, period_us=None, config=None, io_config=None):
+		if config is not None:
+			self.set_trigger_config(config)
+		if io_config is not None:
+			self.set_io_config(io_config)
+		if delay_us is not None:
+			self.set_trigger_delay_us(delay_us)
+		if period_us is not None:
+			self.set_pulse_period_us(period_us)
+		self.set_external_trigger_enabled(external)
+
+	# Arm count triggered exposures with one request and stream the frames back as they land in the FIFO.
+	# Yields (spectra, headers, host_ns) batches, headers carry the device timestamps (start of exposure),
+	# host_ns has them in host time.monotonic_ns() if clock sync is enabled, None otherwise.
+	# timeout is the longest gap between frames (seconds), pending exposures are stopped if it runs out
+	def stream_burst(self, count, timeout=None, poll_interval=0.002):
+		if count < 1:
+			raise ValueError('Burst needs at least one exposure, got %d' % count)
+		self.start_exposure(count)
+		received = 0
+		last_frame = time.monotonic()
+		try:
+			while received < count:
+				available = self.get_available_spectra_count()
+				if available == 0:
+					if timeout is not None and time.monotonic() - last_frame > timeout:
+						raise TimeoutError('Got %d of %d triggered spectra' % (received, count))
+					time.sleep(poll_interval)
+					continue
+				spectra, headers = self.drain(max_count=count - received)
+				received += len(spectra)
+				last_frame = time.monotonic()
+				host_ns = headers['host_ns'].copy() if self.clock is not None else None
+				# drain() buffers get reused by the next batch
+				yield spectra.copy(), headers.copy(), host_ns
+		finally:
+			if received < count:
+				self.stop_exposure()
+
+	# stream_burst() collected into (count x pixels spectra, headers, host_ns)
+	def acquire_burst(self, count, timeout=None, poll_interval=0.002):
+		return collect_burst(self.stream_burst(count, timeout, poll_interval))
+
+	# poll FIFO until at least count spectra are available, returns the available count
+	def wait_for_spectra(self, count=1, timeout=None, poll_interval=0.01):
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while True:
+			available = self.get_available_spectra_count()
+			if available >= count:
+				return available
+			if deadline is not None and time.monotonic() > deadline:
+				raise TimeoutError('Got %d of %d spectra' % (available, count))
+			time.sleep(poll_interval)
+
+	# Read all spectra currently in the device FIFO (or at most max_count) into preallocated arrays.
+	# out (N x pixel count float32, N x readout.output_count with a readout configuration) and headers (N of DRAIN_HEADER_DTYPE,
+	# or SPECTRUM_HEADER_DTYPE without host time) may be supplied by the caller,
+	# otherwise internal pooled buffers are used, which get overwritten by the next drain() call.
+	# Returns (spectra, headers) views trimmed to the number of spectra read
+	def drain(self, out=None, headers=None, max_count=None):
+		count = self.get_available_spectra_count()
+		if max_count is not None:
+			count = min(count, max_count)
+		pixel_count = self.get_pixel_count() if self.readout is None else self.readout.output_count
+		if out is None:
+			if self._drain_spectra is None or len(self._drain_spectra) < count:
+				self._drain_spectra = np.empty((count, pixel_count), dtype=np.float32)
+			out = self._drain_spectra
+		if headers is None:
+			if self._drain_headers is None or len(self._drain_headers) < count:
+				self._drain_headers = np.empty(count, dtype=DRAIN_HEADER_DTYPE)
+			headers = self._drain_headers
+		if len(out) < count or len(headers) < count:
+			raise ValueError('Buffers too small for %d spectra' % count)
+		host_ns = headers['host_ns'] if 'host_ns' in headers.dtype.names else None
+		if count and self.clock is not None:
+			self._update_clock()
+		for i in range(count):
+			self._read_spectrum_into(out[i], headers[i:i + 1])
+			if host_ns is None:
+				continue
+			if self.clock is None:
+				host_ns[i] = time.monotonic_ns()
+			else:
+				host_ns[i] = self.clock.to_host_ns(int(headers['timestamp'][i]))
+		return out[:count], headers[:count]
+
+	def _read_spectrum_into(self, row, header):
+		reg = format_message(MsgType.DATA, MsgKind.MSG_GET, MsgBulkDataType.SPECTRUM)
+		length = self._retry(reg, lambda: self._request_spectrum(reg))
+		# device header is the leading part of either record type
+		header.view(np.uint8)[:SPECTRUM_HEADER_SIZE] = np.frombuffer(self._rx_buffer, np.uint8, SPECTRUM_HEADER_SIZE, 4)
+		# binned spectra are shorter than the full row
+		pixel_count = min(int(header['pixel_count'][0]), (length - 4 - SPECTRUM_HEADER_SIZE) // 4)
+		if self.readout is not None:
+			if pixel_count < self.readout.stop:
+				raise ValueError('Spectrum of %d pixels does not cover readout region' % pixel_count)
+			self.readout.apply(np.frombuffer(self._rx_buffer, '<f4', self.readout.stop, 4 + SPECTRUM_HEADER_SIZE), row)
+			return
+		pixel_count = min(pixel_count, len(row))
+		row[:pixel_count] = np.frombuffer(self._rx_buffer, '<f4', pixel_count, 4 + SPECTRUM_HEADER_SIZE)
+		row[pixel_count:] = 0
+
+	def _request_spectrum(self, reg):
+		self._write_register(reg)
+		# always the full frame, a readout configuration only applies after receiving
+		length = self._read_bus_into(reg, 4 + SPECTRUM_HEADER_SIZE + 4 * self.get_pixel_count())
+		if length < 4 + SPECTRUM_HEADER_SIZE:
+			raise ShortResponseError('Spectrum response of %d bytes' % length, reg)
+		return length
+
 	def get_spectrum(self):
 		response = self._read_bulk_data(MsgBulkDataType.SPECTRUM)
+		received_ns = time.monotonic_ns()
 		spectrum = Spectrum.parse_bytes(response)
+		spectrum.received_ns = received_ns
+		if self.readout is not None:
+			spectrum.amplitudes = self.readout.apply(np.asarray(spectrum.amplitudes, dtype=np.float32))
+		if self.clock is not None:
+			self._update_clock()
+			spectrum.host_timestamp_ns = self.clock.to_host_ns(spectrum.header.timestamp)
 		return spectrum
 
 	def terminate(self):
-		self._write_register(format_message(MsgType.COMMAND, MsgKind.MSG_GET, MsgCommand.CMD_BYE))
-		usb.util.dispose_resources(self._dev)
+		try:
+			self._write_register(format_message(MsgType.COMMAND, MsgKind.MSG_GET, MsgCommand.CMD_BYE))
+		finally:
+			if _bound_devices.get(_device_key(self._dev)) is self:
+				del _bound_devices[_device_key(self._dev)]
+			usb.util.dispose_resources(self._dev)
 
 	def _send_init(self):
 		msg = format_message(MsgType.COMMAND, MsgKind.MSG_GET, MsgCommand.CMD_INIT)
@@ -334,6 +837,9 @@ class Spectrometer:
 	def _read_bulk_data(self, param: MsgBulkDataType):
 		return self._read_register(format_message(MsgType.DATA, MsgKind.MSG_GET, param))
 
+	def _write_int_param(self, param: MsgDeviceParameter, value):
+		self._write_int_to_reg(format_message(MsgType.PARAMETER, MsgKind.MSG_SET, param), value)
+
 	def _write_int_to_reg(self, reg, value):
 		packed = struct.pack('<Ii', reg, value)
 		self._write_bus(packed)
@@ -343,18 +849,57 @@ class Spectrometer:
 		self._write_bus(packed)
 
 	def _read_register(self, reg):
+		return self._retry(reg, lambda: self._exchange(reg))
+
+	def _exchange(self, reg):
 		self._write_register(reg)
-		# self._ep_out.write(data)
 		resp = self._read_bus()
-		status = MsgReturnCode(unpack_int(resp[:4]))
-		if status is not MsgReturnCode.OK:
-			self.log.error('Response to request %s was %s', reg, status.name)
+		check_response(reg, resp, len(resp))
+		# INIT is answered with the return code only
 		if (len(resp) <= 4) and (reg != 0x00):
-			self.log.warning('Received too few bytes, retrying')
-			time.sleep(1)
-			return self._read_register(reg)
+			raise ShortResponseError('Response to request 0x%x has no data' % reg, reg)
 		return resp[4:]
 
+	# Run request() under the retry policy, request has to send the request and read the complete response
+	def _retry(self, reg, request):
+		attempt = 1
+		while True:
+			try:
+				result = request()
+			except QredError as e:
+				if not self.retry_policy.is_retryable(e) or attempt >= self.retry_policy.max_attempts:
+					self.retry_stats.failed += 1
+					self.log.error('Request 0x%x failed after %d attempt(s): %s', reg, attempt, e)
+					raise
+				delay = self.retry_policy.delay(attempt)
+				self.retry_stats.add_retry(e)
+				self.log.warning('Request 0x%x: %s, retrying in %.1f ms', reg, e, delay * 1000)
+				time.sleep(delay)
+				self._resync()
+				attempt += 1
+				continue
+			if attempt > 1:
+				self.retry_stats.recovered += 1
+			return result
+
+	# drop leftovers of earlier responses from the IN endpoint, so the next response lines up with its request
+	def _resync(self):
+		drained = 0
+		for _ in range(64):
+			try:
+				n = len(self._ep_in.read(self.__max_rx_data_length, self.retry_policy.drain_timeout_ms))
+			except usb.core.USBTimeoutError:
+				break
+			if n == 0:
+				break
+			drained += n
+		if drained:
+			self.retry_stats.drained_bytes += drained
+			self.log.warning('Dropped %d stale bytes', drained)
+
+	def get_retry_stats(self):
+		return self.retry_stats.as_dict()
+
 	def _write_register(self, reg):
 		data = struct.pack('<I', reg)
 		self._write_bus(data)
@@ -364,14 +909,59 @@ class Spectrometer:
 		self._ep_out.write(data)
 
 	def _read_bus(self):
-		resp = self._ep_in.read(self.__max_rx_data_length)
-		self.log.debug('<: [{}]'.format(','.join(hex(x) for x in resp)))
+		try:
+			resp = self._ep_in.read(self.__max_rx_data_length)
+		except usb.core.USBTimeoutError as e:
+			raise ResponseTimeoutError(str(e))
+		if self.log.isEnabledFor(logging.DEBUG):
+			self.log.debug('<: [{}]'.format(','.join(hex(x) for x in resp)))
 		return resp
 
+	# Read the response to reg of up to expected bytes into self._rx_buffer without allocating,
+	# responses split over several transfers are reassembled. Returns number of bytes received
+	def _read_bus_into(self, reg, expected):
+		try:
+			return self._reassemble(reg, expected)
+		except usb.core.USBTimeoutError as e:
+			raise ResponseTimeoutError(str(e))
+
+	# Error replies carry the return code only and get raised after the first transfer.
+	# Spectra end after the pixel count in their header (binned ones are shorter than expected),
+	# and a short packet always ends the response, so nothing waits for the read timeout
+	def _reassemble(self, reg, expected):
+		length = n = self._ep_in.read(self._rx_buffer)
+		check_response(reg, self._rx_buffer, length)
+		if length >= 4 + SPECTRUM_HEADER_SIZE:
+			pixel_count, = struct.unpack_from('<H', self._rx_buffer, 4 + SPECTRUM_HEADER_DTYPE.fields['pixel_count'][1])
+			expected = min(expected, 4 + SPECTRUM_HEADER_SIZE + 4 * pixel_count)
+		rx = memoryview(self._rx_buffer)
+		while length < expected and n % self._packet_size == 0:
+			n = self._ep_in.read(self._rx_chunk)
+			if n == 0:
+				break
+			n = min(n, len(rx) - length)
+			rx[length:length + n] = memoryview(self._rx_chunk)[:n]
+			length += n
+		if self.log.isEnabledFor(logging.DEBUG):
+			self.log.debug('<: %d bytes', length)
+		return length
+
+	# receive buffers sized for the largest response, i.e. full spectrum with header
+	def _alloc_rx_buffers(self):
+		self._packet_size = getattr(self._ep_in, 'wMaxPacketSize', 512) or 512
+		frame_size = 4 + SPECTRUM_HEADER_SIZE + 4 * self._pixel_count
+		# round up to full packets, libusb overflows otherwise
+		size = -(-frame_size // self._packet_size) * self._packet_size
+		self.__max_rx_data_length = max(16384, size)
+		self._rx_buffer = array('B', bytes(self.__max_rx_data_length))
+		self._rx_chunk = array('B', bytes(self.__max_rx_data_length))
+
 
 class Spectrum:
 	header = None
 	amplitudes = []  # The spectrum as a float array
+	received_ns = None  # host time.monotonic_ns() when readout completed
+	host_timestamp_ns = None  # header.timestamp in host time.monotonic_ns(), needs Spectrometer.enable_clock_sync()
 
 	@classmethod
 	def parse_bytes(cls, data_bytes):
@@ -428,6 +1018,101 @@ class Spectrum:
 			inst.unit = Spectrum.SpectrumHeader.SpectrometerUnits(inst.unit)
 			return inst
 
+		def get_applied_steps(self):
+			return ProcessingSteps(self.applied_processing)
+
+
+# stream_burst() batches concatenated into (count x pixels spectra, headers, host_ns)
+def collect_burst(batches):
+	batches = list(batches)
+	host_ns = None
+	if batches[0][2] is not None:
+		host_ns = np.concatenate([b[2] for b in batches])
+	return np.concatenate([b[0] for b in batches]), np.concatenate([b[1] for b in batches]), host_ns
+
+
+PAGE_COUNT_PROPERTIES = {
+	MsgBulkDataType.CAL_DATA: MsgDevicePropertyRequest.PAGE_COUNT_CAL_DATA,
+	MsgBulkDataType.USER_DATA: MsgDevicePropertyRequest.PAGE_COUNT_USER_DATA,
+}
+
+# {(serial number, MsgBulkDataType): [page bytes]}
+_paged_data_cache = {}
+
+def _import_usb():
+	global usb
+	if usb is None:
+		import usb.core
+		import usb.util
+	return usb
+
+def find_devices():
+	_import_usb()
+	return list(usb.core.find(find_all=True, idVendor=VENDOR_ID, idProduct=PRODUCT_ID))
+
+# {device key: Spectrometer} of units open in this process
+_bound_devices = {}
+
+def _device_key(dev):
+	if getattr(dev, 'bus', None) is None:
+		return id(dev)
+	return dev.bus, dev.address
+
+# Returns {serial number: usb device} of all connected units not already open in this process.
+# Serial comes from the USB descriptor, units without one get opened briefly and queried for SERIAL_NO
+def enumerate_devices():
+	devices = {}
+	for dev in find_devices():
+		if _device_key(dev) in _bound_devices:
+			continue
+		serial_number = _descriptor_serial(dev)
+		if serial_number is None:
+			serial_number = _probe_serial(dev)
+		if serial_number is not None:
+			devices[serial_number] = dev
+	return devices
+
+def _descriptor_serial(dev):
+	index = getattr(dev, 'iSerialNumber', 0)
+	if not index:
+		return None
+	try:
+		return usb.util.get_string(dev, index) or None
+	except (usb.core.USBError, ValueError, NotImplementedError):
+		return None
+
+def _probe_serial(dev):
+	spec = Spectrometer.__new__(Spectrometer)
+	spec.log = logging.getLogger('Qred')
+	opened = False
+	try:
+		spec._open(dev)
+		opened = True
+		return spec.get_serial_number()
+	except (usb.core.USBError, QredError) as e:
+		# most likely claimed by another process
+		spec.log.warning('Skipping Qred at bus %s address %s: %s', getattr(dev, 'bus', '?'), getattr(dev, 'address', '?'), e)
+		return None
+	finally:
+		try:
+			if opened:
+				spec._write_register(format_message(MsgType.COMMAND, MsgKind.MSG_GET, MsgCommand.CMD_BYE))
+		except usb.core.USBError:
+			pass
+		finally:
+			usb.util.dispose_resources(dev)
+
+# raise the matching QredError unless resp (length bytes received) starts with MsgReturnCode.OK
+def check_response(reg, resp, length):
+	if length < 4:
+		raise ShortResponseError('Response to request 0x%x has %d bytes' % (reg, length), reg)
+	code = unpack_int(resp[:4])
+	try:
+		status = MsgReturnCode(code)
+	except ValueError:
+		raise MalformedResponseError('Request 0x%x returned unknown code 0x%x' % (reg, code), reg)
+	if status is not MsgReturnCode.OK:
+		raise RETURN_CODE_ERRORS.get(status, QredError)('Request 0x%x returned %s' % (reg, status.name), reg)
 
 def format_message(msgt :MsgType, msgk :MsgKind, body):
 	return msgt.value << 12 | msgk.value << 8 | body.value
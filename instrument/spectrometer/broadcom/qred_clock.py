@@ -0,0 +1,80 @@
+from collections import deque
+
+TICK_WRAP = 1 << 32
+TICK_NS = 1000000  # device ticks are 1 ms
+
+
+class DeviceClock:
+	'''
+	Maps the 32-bit millisecond device tick counter (VAL_SYSTICK, SpectrumHeader.timestamp)
+	onto host time.monotonic_ns().
+	Keeps a window of (unwrapped tick, host ns) pairs and fits host = offset + rate * tick with least squares,
+	so that both offset and drift of the device oscillator are tracked.
+	'''
+	rate_ns = float(TICK_NS)  # host ns per device tick
+
+	# rate is only fitted once samples span min_fit_span ticks, below that 1 ms tick quantisation dominates
+	def __init__(self, window=32, min_fit_span=10000) -> None:
+		super().__init__()
+		self.min_fit_span = min_fit_span
+		self._samples = deque(maxlen=window)
+		self._last_unwrapped = None
+		self._min_round_trip_ns = None
+		self.last_sync_ns = None
+
+	def is_synced(self):
+		return len(self._samples) > 0
+
+	# drift of the device clock relative to host clock in ppm, positive when device clock runs slow
+	def get_drift_ppm(self):
+		return (self.rate_ns / TICK_NS - 1.0) * 1e6
+
+	# ticks read in between host times before_ns and after_ns
+	def add_sample(self, ticks, before_ns, after_ns):
+		round_trip = after_ns - before_ns
+		if self._min_round_trip_ns is None or round_trip < self._min_round_trip_ns:
+			self._min_round_trip_ns = round_trip
+		self.last_sync_ns = after_ns
+		unwrapped = self.unwrap(ticks)
+		self._last_unwrapped = unwrapped
+		# samples delayed by a slow round trip carry large uncertainty on the host side
+		if self._samples and round_trip > 2 * self._min_round_trip_ns + 100000:
+			return
+		self._samples.append((unwrapped, (before_ns + after_ns) // 2))
+		self._fit()
+
+	# 32-bit counter value to unwrapped tick count, picking the wrap closest to the last sync
+	def unwrap(self, ticks):
+		if self._last_unwrapped is None:
+			return ticks
+		base = self._last_unwrapped - (self._last_unwrapped % TICK_WRAP)
+		candidate = base + ticks
+		if candidate - self._last_unwrapped > TICK_WRAP // 2:
+			candidate -= TICK_WRAP
+		elif self._last_unwrapped - candidate > TICK_WRAP // 2:
+			candidate += TICK_WRAP
+		return candidate
+
+	def to_host_ns(self, ticks):
+		if not self._samples:
+			raise ValueError('Clock not synchronised')
+		return int(self._ref_host_ns + self.rate_ns * (self.unwrap(ticks) - self._ref_ticks))
+
+	# host time corresponding to device tick 0
+	def get_offset_ns(self):
+		return int(self._ref_host_ns - self.rate_ns * self._ref_ticks)
+
+	def _fit(self):
+		n = len(self._samples)
+		t0, h0 = self._samples[0]
+		mean_t = sum(t - t0 for t, _ in self._samples) / n
+		mean_h = sum(h - h0 for _, h in self._samples) / n
+		if self._samples[-1][0] - t0 >= self.min_fit_span:
+			den = sum((t - t0 - mean_t) ** 2 for t, _ in self._samples)
+			num = sum((t - t0 - mean_t) * (h - h0 - mean_h) for t, h in self._samples)
+			self.rate_ns = num / den
+		else:
+			self.rate_ns = float(TICK_NS)
+		# fitted line passes through the centroid, keep it as reference to stay clear of float precision limits
+		self._ref_ticks = t0 + mean_t
+		self._ref_host_ns = h0 + mean_h
@@ -0,0 +1,96 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .qred import Spectrometer, enumerate_devices
+
+
+class AcquisitionResult:
+	serial_number = None
+	start_ns = 0  # host time.monotonic_ns() right before the exposure was started
+	spectra = []  # Spectrum objects, each with received_ns set
+
+	def __init__(self, serial_number, start_ns, spectra) -> None:
+		self.serial_number = serial_number
+		self.start_ns = start_ns
+		self.spectra = spectra
+
+
+class SpectrometerGroup:
+	'''
+	Set of Qred units operated together. Every group operation runs on all members
+	in parallel through a thread pool and returns {serial number: result}.
+	Members are still regular Spectrometer objects reachable via group[serial].
+	'''
+	log = None
+	members = {}
+
+	def __init__(self, spectrometers) -> None:
+		super().__init__()
+		self.log = logging.getLogger('QredGroup')
+		self.members = {}
+		for spec in spectrometers:
+			self.members[spec.get_serial_number()] = spec
+		self._pool = ThreadPoolExecutor(max_workers=max(1, len(self.members)), thread_name_prefix='QredGroup')
+
+	# open all connected units or only the listed ones
+	@classmethod
+	def open(cls, serial_numbers=None):
+		devices = enumerate_devices()
+		if serial_numbers is None:
+			serial_numbers = sorted(devices)
+		missing = [sn for sn in serial_numbers if sn not in devices]
+		if missing:
+			raise ValueError('Devices not found: %s' % ', '.join(missing))
+		return cls([Spectrometer(usb_device=devices[sn]) for sn in serial_numbers])
+
+	def __getitem__(self, serial_number):
+		return self.members[serial_number]
+
+	def __len__(self):
+		return len(self.members)
+
+	def serial_numbers(self):
+		return list(self.members)
+
+	# call fn(spectrometer, *args) for every member in parallel
+	def map(self, fn, *args):
+		futures = {sn: self._pool.submit(fn, spec, *args) for sn, spec in self.members.items()}
+		return {sn: f.result() for sn, f in futures.items()}
+
+	def set_exposure_time_ms(self, value):
+		return self.map(Spectrometer.set_exposure_time_ms, value)
+
+	def start_exposure(self, count=1):
+		return self.map(SpectrometerGroup._start_one, count)
+
+	def get_spectra(self, count=1, timeout=None):
+		return self.map(SpectrometerGroup._collect_one, count, timeout)
+
+	# start count exposures on every member and collect them, returns {serial: AcquisitionResult}
+	def acquire(self, count=1, timeout=None):
+		return self.map(SpectrometerGroup._acquire_one, count, timeout)
+
+	def terminate(self):
+		self.map(Spectrometer.terminate)
+		self._pool.shutdown()
+
+	@staticmethod
+	def _start_one(spec, count):
+		start_ns = time.monotonic_ns()
+		spec.start_exposure(count)
+		return start_ns
+
+	@staticmethod
+	def _collect_one(spec, count, timeout):
+		spec.wait_for_spectra(count, timeout)
+		return [spec.get_spectrum() for _ in range(count)]
+
+	@staticmethod
+	def _acquire_one(spec, count, timeout):
+		# don't poll the bus while the device is still integrating
+		expected = spec.get_exposure_time_us() * spec.get_averaging() * count / 1e6
+		start_ns = SpectrometerGroup._start_one(spec, count)
+		time.sleep(expected)
+		spectra = SpectrometerGroup._collect_one(spec, count, timeout)
+		return AcquisitionResult(spec.get_serial_number(), start_ns, spectra)
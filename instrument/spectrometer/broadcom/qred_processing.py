@@ -0,0 +1,132 @@
+import numpy as np
+
+from ..pipeline import DarkSubtract, LinearityCorrection, Pipeline, Stage, as_batch
+from .qred import ProcessingSteps
+
+# corrections the host can take over, in the order they are run (same as the firmware chain and bit order)
+HOST_STEPS = (
+	ProcessingSteps.ADJUST_OFFSET,
+	ProcessingSteps.CORRECT_NONLINEARITY,
+	ProcessingSteps.REMOVE_BAD_PIXELS,
+	ProcessingSteps.SUBTRACT_DARK,
+)
+HOST_STEPS_MASK = ProcessingSteps.ADJUST_OFFSET | ProcessingSteps.CORRECT_NONLINEARITY | \
+	ProcessingSteps.SUBTRACT_DARK | ProcessingSteps.REMOVE_BAD_PIXELS
+
+
+class OffsetAdjust(Stage):
+	name = 'offset'
+
+	# offset level is taken from the dark (or offset) pixels of pixel_map
+	def __init__(self, pixel_map) -> None:
+		super().__init__()
+		self.pixel_map = pixel_map
+
+	def process(self, batch):
+		return self.pixel_map.subtract_dark(batch)
+
+
+class BadPixelRemove(Stage):
+	name = 'bad_pixels'
+
+	# unlike BadPixelFix keeps all pixels, as the firmware does
+	def __init__(self, pixel_map) -> None:
+		super().__init__()
+		self.pixel_map = pixel_map
+
+	def process(self, batch):
+		return self.pixel_map.fix_bad_pixels(batch)
+
+
+class ProcessingSplit:
+	'''
+	Divides corrections between the Qred firmware and the host. device steps get written to PROCESSING_STEPS,
+	host steps run as pipeline stages after the device, so every host step has to come later in the chain
+	than all device steps. Every frame reports what the firmware actually did (applied_processing),
+	host stages for steps already applied are skipped, so no correction is done twice or left out
+	while the device setting changes. Pipelines are built once per applied_processing value
+	'''
+
+	# nonlinearity is a LinearityCorrection stage, dark a dark spectrum of full frame width
+	def __init__(self, device=ProcessingSteps.NONE, host=ProcessingSteps.NONE, pixel_map=None, nonlinearity=None,
+			dark=None) -> None:
+		super().__init__()
+		self.device = ProcessingSteps(device)
+		self.host = ProcessingSteps(host)
+		unsupported = self.host & ~HOST_STEPS_MASK
+		if unsupported:
+			raise ValueError('%s can only run on the device' % unsupported.name)
+		# bits are in chain order, the host can only carry on where the device stopped
+		host_only = int(self.host & ~self.device)
+		if host_only and self.device:
+			first_host = ProcessingSteps(host_only & -host_only)
+			last_device = ProcessingSteps(1 << (int(self.device).bit_length() - 1))
+			if first_host < last_device:
+				raise ValueError('%s on the host would run after %s on the device' % (first_host.name, last_device.name))
+		needs_map = ProcessingSteps.ADJUST_OFFSET | ProcessingSteps.REMOVE_BAD_PIXELS
+		if self.host & needs_map and pixel_map is None:
+			raise ValueError('Offset and bad pixel correction on the host need a pixel map')
+		if self.host & ProcessingSteps.CORRECT_NONLINEARITY and nonlinearity is None:
+			raise ValueError('Nonlinearity correction on the host needs coefficients')
+		if self.host & ProcessingSteps.SUBTRACT_DARK and dark is None:
+			raise ValueError('Dark subtraction on the host needs a dark spectrum')
+		self.pixel_map = pixel_map
+		self.nonlinearity = nonlinearity
+		self.dark = dark
+		self._pipelines = {}
+
+	# Reads whatever the host steps need from the device. Nonlinearity coefficients are taken as
+	# a polynomial in increasing order giving the factor to divide by, like Freedom's
+	@classmethod
+	def for_spectrometer(cls, spec, device=ProcessingSteps.NONE, host=ProcessingSteps.NONE, dark=None):
+		host = ProcessingSteps(host)
+		pixel_map = None
+		nonlinearity = None
+		if host & (ProcessingSteps.ADJUST_OFFSET | ProcessingSteps.REMOVE_BAD_PIXELS):
+			pixel_map = spec.get_pixel_map()
+		if host & ProcessingSteps.CORRECT_NONLINEARITY:
+			nonlinearity = LinearityCorrection(spec.get_nonlinearity_coefficients(), divide=True)
+		return cls(device, host, pixel_map, nonlinearity, dark)
+
+	def configure(self, spec):
+		spec.set_processing_steps(self.device)
+
+	# host steps still to do on frames with the given applied_processing
+	def host_steps(self, applied):
+		return self.host & ~ProcessingSteps(int(applied))
+
+	def pipeline(self, applied):
+		steps = self.host_steps(applied)
+		pipeline = self._pipelines.get(steps)
+		if pipeline is None:
+			pipeline = Pipeline(self._stages(steps))
+			self._pipelines[steps] = pipeline
+		return pipeline
+
+	# spectra batch with matching headers (SPECTRUM_HEADER_DTYPE records, e.g. from drain())
+	def process(self, batch, headers):
+		batch = as_batch(batch)
+		applied = np.asarray(headers['applied_processing'])
+		values = np.unique(applied)
+		if len(values) == 1:
+			return self.pipeline(values[0]).process(batch)
+		out = np.empty(batch.shape)
+		for value in values:
+			rows = applied == value
+			out[rows] = self.pipeline(value).process(batch[rows])
+		return out
+
+	def _stages(self, steps):
+		stages = []
+		for step in HOST_STEPS:
+			if not steps & step:
+				continue
+			if step is ProcessingSteps.ADJUST_OFFSET:
+				stages.append(OffsetAdjust(self.pixel_map))
+			elif step is ProcessingSteps.CORRECT_NONLINEARITY:
+				stages.append(self.nonlinearity)
+			elif step is ProcessingSteps.SUBTRACT_DARK:
+				stages.append(DarkSubtract(self.dark))
+			elif step is ProcessingSteps.REMOVE_BAD_PIXELS:
+				stages.append(BadPixelRemove(self.pixel_map))
+		return stages
@@ -0,0 +1,186 @@
+import functools
+import inspect
+import itertools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from ..tec_settle import SettleMonitor
+from .qred import Spectrometer, TECStatus, collect_burst
+
+# request priorities, lower is served first
+READOUT = 0
+CONTROL = 1
+TELEMETRY = 2
+
+# Priority of pure reads called through a session. Anything not listed, in particular every command changing
+# device state (start_exposure, set_exposure_time_ms, ...), runs as CONTROL in submission order
+METHOD_PRIORITIES = {
+	'get_available_spectra_count': READOUT,
+	'get_spectrum': READOUT,
+	'drain': READOUT,
+	'get_systick': READOUT,
+	'sync_clock': READOUT,
+	'get_sensor_temp': TELEMETRY,
+	'get_sink_temp': TELEMETRY,
+	'get_tec_status': TELEMETRY,
+	'get_target_temp': TELEMETRY,
+}
+
+
+# drain() results point into pooled buffers the next drain() overwrites, results handed to other threads get copied
+def _drain_copy(spec, out=None, headers=None, max_count=None):
+	spectra, records = spec.drain(out, headers, max_count)
+	return spectra if out is not None else spectra.copy(), records if headers is not None else records.copy()
+
+
+# session replacements of Spectrometer methods
+SESSION_METHODS = {
+	'drain': _drain_copy,
+}
+
+
+class QredSession:
+	'''
+	Shares one Qred between threads. A worker thread is the only one talking to the device,
+	requests from any thread go through a priority queue and complete futures.
+	Readout reads are served before control and telemetry requests, equal priorities in submission order.
+	A request never overtakes an earlier pending one of the same thread, so a thread's
+	set_exposure_time_ms() followed by get_spectrum() keeps its order.
+	A running request is never interrupted, so telemetry delays readout by one register exchange at most.
+	Spectrometer methods are available on the session directly: session.get_sensor_temp() returns a future
+	'''
+	log = None
+
+	def __init__(self, spectrometer, name='QredSession') -> None:
+		super().__init__()
+		self.log = logging.getLogger(name)
+		self.spectrometer = spectrometer
+		self._queue = queue.PriorityQueue()
+		self._seq = itertools.count()
+		self._last = {}  # {thread id: (priority, future) of its last request}
+		self._lock = threading.Lock()
+		self._closed = False
+		self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+		self._thread.start()
+
+	# run fn(spectrometer, *args, **kwargs) on the worker thread
+	def submit(self, fn, *args, priority=CONTROL, **kwargs):
+		if self._closed:
+			raise RuntimeError('Session is closed')
+		future = Future()
+		caller = threading.get_ident()
+		with self._lock:
+			last = self._last.get(caller)
+			# while the caller's previous request is pending, don't sort ahead of it
+			if last is not None and not last[1].done():
+				priority = max(priority, last[0])
+			self._last[caller] = (priority, future)
+			self._queue.put((priority, next(self._seq), future, fn, args, kwargs))
+		future.add_done_callback(lambda f: self._forget(caller, f))
+		return future
+
+	# Call Spectrometer method name, priority defaults to METHOD_PRIORITIES.
+	# Only reads may be given another priority, state changes stay in order with each other
+	def call(self, name, *args, priority=None, **kwargs):
+		if priority is None:
+			priority = METHOD_PRIORITIES.get(name, CONTROL)
+		elif name not in METHOD_PRIORITIES and priority != CONTROL:
+			raise ValueError('%s changes device state and runs as CONTROL' % name)
+		fn = SESSION_METHODS.get(name) or getattr(Spectrometer, name)
+		return self.submit(fn, *args, priority=priority, **kwargs)
+
+	def _forget(self, caller, future):
+		with self._lock:
+			last = self._last.get(caller)
+			if last is not None and last[1] is future:
+				del self._last[caller]
+
+	# Generator methods would only be created on the worker and then run on the caller's thread, outside the session
+	def __getattr__(self, name):
+		fn = getattr(Spectrometer, name, None)
+		if name.startswith('_') or not callable(fn) or inspect.isgeneratorfunction(fn):
+			raise AttributeError(name)
+		return functools.partial(self.call, name)
+
+	# Blocks the calling thread, the worker stays free for other requests between polls
+	def wait_for_spectra(self, count=1, timeout=None, poll_interval=0.01):
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while True:
+			available = self.call('get_available_spectra_count').result()
+			if available >= count:
+				return available
+			if deadline is not None and time.monotonic() > deadline:
+				raise TimeoutError('Got %d of %d spectra' % (available, count))
+			time.sleep(poll_interval)
+
+	# Same as Spectrometer.stream_burst(), every device request goes through the session.
+	# Blocks the calling thread between polls, other requests are served meanwhile
+	def stream_burst(self, count, timeout=None, poll_interval=0.002):
+		if count < 1:
+			raise ValueError('Burst needs at least one exposure, got %d' % count)
+		self.call('start_exposure', count).result()
+		received = 0
+		last_frame = time.monotonic()
+		try:
+			while received < count:
+				available = self.call('get_available_spectra_count').result()
+				if available == 0:
+					if timeout is not None and time.monotonic() - last_frame > timeout:
+						raise TimeoutError('Got %d of %d triggered spectra' % (received, count))
+					time.sleep(poll_interval)
+					continue
+				# session drain() already returns copies
+				spectra, headers = self.call('drain', max_count=count - received).result()
+				received += len(spectra)
+				last_frame = time.monotonic()
+				yield spectra, headers, headers['host_ns'].copy() if self.spectrometer.clock is not None else None
+		finally:
+			if received < count:
+				self.call('stop_exposure').result()
+
+	def acquire_burst(self, count, timeout=None, poll_interval=0.002):
+		return collect_burst(self.stream_burst(count, timeout, poll_interval))
+
+	# same as Spectrometer.settle_temperature(), with temperature polling going through the session
+	def settle_temperature(self, setpoint=None, tolerance=0.1, hold_time=5.0, timeout=600.0, callback=None):
+		if setpoint is not None:
+			self.call('set_target_temp', setpoint).result()
+		else:
+			setpoint = self.call('get_target_temp').result()
+		monitor = SettleMonitor(lambda: self.call('get_sensor_temp').result(), setpoint, tolerance, hold_time, timeout,
+			read_status_fn=lambda: self.call('get_tec_status').result(),
+			fault_states=(TECStatus.UNABLE_TO_REACH, TECStatus.SINK_TOO_HOT),
+			callback=callback, name='QredTEC')
+		return monitor.start()
+
+	# Requests already queued are completed first. With terminate the device connection gets closed too
+	def close(self, terminate=False):
+		if self._closed:
+			return
+		if terminate:
+			self.call('terminate')
+		self._closed = True
+		self._queue.put((float('inf'), next(self._seq), None, None, (), {}))
+		self._thread.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def _run(self):
+		while True:
+			priority, seq, future, fn, args, kwargs = self._queue.get()
+			if future is None:
+				return
+			if not future.set_running_or_notify_cancel():
+				continue
+			try:
+				future.set_result(fn(self.spectrometer, *args, **kwargs))
+			except BaseException as e:
+				self.log.debug('Request %s failed: %s', getattr(fn, '__name__', fn), e)
+				future.set_exception(e)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+import logging
+
+import time
+
+from instrument.spectrometer.broadcom.qred import Spectrometer, ProcessingSteps
+from instrument.spectrometer.broadcom.qred_processing import ProcessingSplit
+
+# Frame rate and host CPU load of continuous acquisition with corrections split differently
+# between firmware and host. Dark subtraction is left out, it needs a dark spectrum on the host side
+CORRECTIONS = ProcessingSteps.ADJUST_OFFSET | ProcessingSteps.CORRECT_NONLINEARITY | ProcessingSteps.REMOVE_BAD_PIXELS
+SPLITS = [
+	('none', ProcessingSteps.NONE, ProcessingSteps.NONE),
+	('all on host', ProcessingSteps.NONE, CORRECTIONS),
+	('offset on device', ProcessingSteps.ADJUST_OFFSET, CORRECTIONS & ~ProcessingSteps.ADJUST_OFFSET),
+	('all on device', CORRECTIONS, ProcessingSteps.NONE),
+]
+DURATION = 10.0
+
+
+def run(spec, split):
+	split.configure(spec)
+	spec.start_exposure(continuous=True)
+	frames = 0
+	wall = time.perf_counter()
+	cpu = time.process_time()
+	while time.perf_counter() - wall < DURATION:
+		if spec.get_available_spectra_count() == 0:
+			time.sleep(0.001)
+			continue
+		spectra, headers = spec.drain()
+		split.process(spectra, headers)
+		frames += len(spectra)
+	wall = time.perf_counter() - wall
+	cpu = time.process_time() - cpu
+	spec.stop_exposure()
+	return frames / wall, cpu / wall * 100
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	spec = Spectrometer()
+	original = spec.get_processing_steps()
+	spec.set_exposure_time_ms(spec.get_exposure_time_min_us() / 1000)
+	print('%-20s %10s %10s' % ('split', 'frames/s', 'host CPU'))
+	try:
+		for name, device, host in SPLITS:
+			fps, cpu = run(spec, ProcessingSplit.for_spectrometer(spec, device, host))
+			print('%-20s %10.1f %9.1f%%' % (name, fps, cpu))
+	finally:
+		spec.set_processing_steps(original)
+		spec.terminate()
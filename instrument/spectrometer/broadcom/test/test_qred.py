@@ -6,7 +6,7 @@ import sys
 import time
 from pprint import pprint
 
-from devices.instrument.spectrometer.broadcom.qred import Spectrometer, TECStatus
+from instrument.spectrometer.broadcom.qred import Spectrometer
 
 if __name__ == '__main__':
 	log = logging.getLogger('test')
@@ -23,12 +23,9 @@ if __name__ == '__main__':
 	print('Supply: %3.6f V, USB: %3.6f, cooling: %3.6f A' %(spec.get_supply_voltage(), spec.get_usb_voltage(), spec.get_cooling_current()))
 	tec_status = spec.get_tec_status()
 	print('TEC status: %s, target: %3.6f \'C ' % (tec_status.name, spec.get_target_temp()))
-	spec.set_target_temp(-5.1)
-	while tec_status != TECStatus.SETPOINT_REACHED:
-		tec_status = spec.get_tec_status()
-		print('Sensor t: %3.6f \'C, sink t: %3.6f\'C' % (spec.get_sensor_temp(), spec.get_sink_temp()))
-		print('TEC status: %s' % spec.get_tec_status().name)
-		time.sleep(3)
+	settled = spec.settle_temperature(-5.1, tolerance=0.1, hold_time=5)
+	result = settled.result()
+	print('Sensor t: %3.6f \'C settled in %.1f s, TEC status: %s' % (result.temperature, result.elapsed, spec.get_tec_status().name))
 	exposure_time = 5000
 	print('Setting exposure to %d ms' % exposure_time)
 	spec.set_exposure_time_ms(exposure_time)
@@ -0,0 +1,127 @@
+import numpy as np
+
+from .pipeline import Stage, as_batch
+from .running_stats import RunningStats
+
+
+class ChangeDetect(Stage):
+    '''
+    Forwards only spectra that differ from the last forwarded one. A pixel has changed if it moved by more than
+    threshold noise sigmas (of a difference of two frames), a frame is forwarded if at least min_pixels changed
+    or keyframe_interval frames were suppressed in a row (0 disables keyframes).
+    noise is a per pixel or scalar sigma, e.g. from a RunningStats snapshot or the Qred header noise_level.
+    Without it, noise is estimated per pixel (not below the median over pixels) from consecutive differences
+    of the first warmup frames, which are all forwarded
+    '''
+    name = 'change_detect'
+
+    def __init__(self, threshold=5.0, noise=None, min_pixels=1, keyframe_interval=1000, warmup=16,
+                 min_noise=1e-6) -> None:
+        super().__init__()
+        if warmup < 2:
+            raise ValueError('Noise estimate needs at least 2 warmup frames')
+        self.threshold = threshold
+        self.min_pixels = min_pixels
+        self.keyframe_interval = keyframe_interval
+        self.warmup = warmup
+        self.min_noise = min_noise
+        self.received = 0
+        self.forwarded = 0
+        self.suppressed = 0
+        self.keyframes = 0
+        self._since_forwarded = 0
+        self._reference = None
+        self._previous = None
+        self._warmup_stats = None
+        self._limit = None
+        self.set_noise(noise)
+
+    def set_noise(self, noise):
+        self.noise = None if noise is None else np.maximum(np.asarray(noise, dtype=np.float64), self.min_noise)
+        # difference of two frames has sqrt(2) times the noise of one
+        self._limit = None if self.noise is None else self.threshold * np.sqrt(2) * self.noise
+
+    def set_noise_from_stats(self, stats):
+        self.set_noise(stats.snapshot().std())
+
+    # mean noise_level of Qred SPECTRUM_HEADER_DTYPE records, frames without it (-1) are ignored
+    def set_noise_from_headers(self, headers):
+        levels = np.asarray(headers['noise_level'], dtype=np.float64)
+        levels = levels[levels > 0]
+        if not len(levels):
+            raise ValueError('No noise level in headers')
+        self.set_noise(levels.mean())
+
+    def reset(self):
+        self._reference = None
+        self._since_forwarded = 0
+
+    # fraction of received frames that were dropped
+    def suppression_ratio(self):
+        return self.suppressed / self.received if self.received else 0.0
+
+    # indices of batch rows to forward
+    def select(self, batch):
+        batch = as_batch(batch)
+        selected = []
+        start = 0
+        if self._limit is None:
+            start = self._learn(batch)
+            selected.extend(range(start))
+            if start:
+                self._forward(batch[start - 1], keyframe=False)
+                self.forwarded += start - 1
+        while start < len(batch):
+            rest = batch[start:]
+            if self._reference is None:
+                index = 0
+            else:
+                # all remaining rows against the reference at once, first one over the limit gets forwarded
+                changed = np.count_nonzero(np.abs(rest - self._reference) > self._limit, axis=1)
+                candidates = np.flatnonzero(changed >= self.min_pixels)
+                index = candidates[0] if len(candidates) else len(rest)
+            keyframe = False
+            if self.keyframe_interval and self._reference is not None:
+                due = self.keyframe_interval - self._since_forwarded
+                if due < index:
+                    index = due
+                    keyframe = True
+            self.suppressed += min(index, len(rest))
+            self._since_forwarded += min(index, len(rest))
+            if index >= len(rest):
+                break
+            selected.append(start + index)
+            self._forward(rest[index], keyframe)
+            start += index + 1
+        self.received += len(batch)
+        return np.array(selected, dtype=np.intp)
+
+    def process(self, batch):
+        return batch[self.select(batch)]
+
+    def _forward(self, spectrum, keyframe):
+        self._reference = spectrum.copy()
+        self._since_forwarded = 0
+        self.forwarded += 1
+        if keyframe:
+            self.keyframes += 1
+
+    # feeds warmup frames into the noise estimate, returns how many of batch were used
+    def _learn(self, batch):
+        if self._warmup_stats is None:
+            self._warmup_stats = RunningStats()
+        used = max(min(self.warmup - self._warmup_stats.count - (self._previous is not None), len(batch)), 0)
+        if used > 0:
+            frames = batch[:used]
+            if self._previous is not None:
+                frames = np.concatenate((self._previous[np.newaxis], frames))
+            if len(frames) > 1:
+                self._warmup_stats.update(np.diff(frames, axis=0) / np.sqrt(2))
+            self._previous = batch[used - 1].copy()
+        if self._warmup_stats.count + 1 >= self.warmup:
+            # few samples per pixel, keep pixels that happened to look quiet from getting a tight limit
+            noise = self._warmup_stats.snapshot().std()
+            self.set_noise(np.maximum(noise, np.median(noise)))
+            self._warmup_stats = None
+            self._previous = None
+        return used
@@ -0,0 +1,264 @@
+import io
+import json
+import lzma
+import struct
+import zlib
+
+import numpy as np
+
+NONE = 'none'
+ZLIB = 'zlib'
+LZMA = 'lzma'
+
+MAGIC = b'SPZ1'
+CHUNK_HEADER = struct.Struct('<II')  # frame count, payload length, zero count ends the chunks
+FOOTER = struct.Struct('<QI4s')  # index offset, chunk count, magic
+INDEX_ENTRY = struct.Struct('<QI')  # chunk offset, frame count
+
+
+def _compress(data, compressor, level):
+    if compressor == ZLIB:
+        return zlib.compress(data, 6 if level is None else level)
+    if compressor == LZMA:
+        return lzma.compress(data, preset=6 if level is None else level)
+    if compressor == NONE:
+        return data
+    raise ValueError('Unknown compressor %s' % compressor)
+
+
+def _decompress(data, compressor):
+    if compressor == ZLIB:
+        return zlib.decompress(data)
+    if compressor == LZMA:
+        return lzma.decompress(data)
+    if compressor == NONE:
+        return data
+    raise ValueError('Unknown compressor %s' % compressor)
+
+
+# unsigned integer type of the same size, deltas on it wrap around and are exactly reversible
+def _unsigned(dtype):
+    return np.dtype('<u%d' % np.dtype(dtype).itemsize)
+
+
+# First frame of a chunk is a keyframe stored as differences along pixels (spectra are smooth),
+# every following frame as the difference from the previous one. Bytes of the values are shuffled,
+# so the mostly zero high bytes of all deltas end up next to each other before compression
+def encode_chunk(frames, compressor=ZLIB, level=None):
+    frames = np.ascontiguousarray(frames, dtype=frames.dtype.newbyteorder('<'))
+    values = frames.view(_unsigned(frames.dtype))
+    delta = np.empty_like(values)
+    delta[0, 0] = values[0, 0]
+    np.subtract(values[0, 1:], values[0, :-1], out=delta[0, 1:])
+    np.subtract(values[1:], values[:-1], out=delta[1:])
+    shuffled = delta.view(np.uint8).reshape(delta.shape + (-1,)).transpose(2, 0, 1)
+    return _compress(np.ascontiguousarray(shuffled).tobytes(), compressor, level)
+
+
+def decode_chunk(data, count, pixel_count, dtype, compressor=ZLIB):
+    dtype = np.dtype(dtype).newbyteorder('<')
+    unsigned = _unsigned(dtype)
+    shuffled = np.frombuffer(_decompress(data, compressor), dtype=np.uint8)
+    shuffled = shuffled.reshape(unsigned.itemsize, count, pixel_count)
+    delta = np.ascontiguousarray(shuffled.transpose(1, 2, 0)).view(unsigned).reshape(count, pixel_count)
+    # cumulative sums in the unsigned type wrap around the same way the differences did
+    delta[0] = np.cumsum(delta[0], dtype=unsigned)
+    np.cumsum(delta, axis=0, dtype=unsigned, out=delta)
+    return delta.view(dtype)
+
+
+class SpectrumEncoder:
+    '''
+    Lossless compressed spectrum stream. Frames are collected into chunks of chunk_frames, every chunk
+    starts with a keyframe and is compressed on its own (see encode_chunk), so it can be decoded without
+    the ones before it. close() appends an index of chunk offsets for random access.
+    Works on driver output as is: Qred float32 amplitudes, Rock/Freedom integer ADC values
+    '''
+
+    def __init__(self, fileobj, pixel_count, dtype=np.float32, compressor=ZLIB, level=None,
+                 chunk_frames=256) -> None:
+        super().__init__()
+        _compress(b'', compressor, level)
+        self.fileobj = fileobj
+        self.pixel_count = pixel_count
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.compressor = compressor
+        self.level = level
+        self.chunk_frames = chunk_frames
+        self.frame_count = 0
+        self.raw_bytes = 0
+        self.encoded_bytes = 0
+        self.closed = False
+        self._pending = []
+        self._buffered = 0
+        self._index = []
+        meta = json.dumps({
+            'pixel_count': pixel_count,
+            'dtype': self.dtype.str,
+            'compressor': compressor,
+            'chunk_frames': chunk_frames,
+        }).encode()
+        self._offset = self._write(MAGIC + struct.pack('<I', len(meta)) + meta)
+
+    # frames: single spectrum or N x pixel count batch
+    def write(self, frames):
+        if self.closed:
+            raise ValueError('Encoder is closed')
+        frames = np.array(frames, dtype=self.dtype, ndmin=2)
+        if frames.shape[1] != self.pixel_count:
+            raise ValueError('Expected %d pixels, got %d' % (self.pixel_count, frames.shape[1]))
+        self._pending.append(frames)
+        self._buffered += len(frames)
+        self.frame_count += len(frames)
+        if self._buffered >= self.chunk_frames:
+            buffered = np.concatenate(self._pending)
+            full = len(buffered) // self.chunk_frames * self.chunk_frames
+            for start in range(0, full, self.chunk_frames):
+                self._write_chunk(buffered[start:start + self.chunk_frames])
+            self._pending = [buffered[full:]] if full < len(buffered) else []
+            self._buffered = len(buffered) - full
+
+    # writes buffered frames as a (short) chunk
+    def flush(self):
+        if self._buffered:
+            self._write_chunk(np.concatenate(self._pending))
+            self._pending = []
+            self._buffered = 0
+        if hasattr(self.fileobj, 'flush'):
+            self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        index = b''.join(INDEX_ENTRY.pack(offset, count) for offset, count in self._index)
+        index_offset = self._offset + CHUNK_HEADER.size
+        self._write(CHUNK_HEADER.pack(0, 0) + index + FOOTER.pack(index_offset, len(self._index), MAGIC))
+        if hasattr(self.fileobj, 'flush'):
+            self.fileobj.flush()
+
+    def ratio(self):
+        return self.raw_bytes / self.encoded_bytes if self.encoded_bytes else 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write_chunk(self, frames):
+        payload = encode_chunk(frames, self.compressor, self.level)
+        self._index.append((self._offset, len(frames)))
+        self._offset += self._write(CHUNK_HEADER.pack(len(frames), len(payload)) + payload)
+        self.raw_bytes += frames.nbytes
+        self.encoded_bytes += CHUNK_HEADER.size + len(payload)
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        return len(data)
+
+
+def _read_meta(fileobj):
+    if fileobj.read(4) != MAGIC:
+        raise ValueError('Not an encoded spectrum stream')
+    length, = struct.unpack('<I', fileobj.read(4))
+    return json.loads(fileobj.read(length).decode()), 8 + length
+
+
+# Sequential decoding of a stream that does not need to be seekable (pipe, socket file),
+# yields chunks of frames as they arrive and stops at the end marker or at a chunk cut short
+def decode_stream(fileobj):
+    meta, _ = _read_meta(fileobj)
+    dtype = np.dtype(meta['dtype'])
+    while True:
+        header = fileobj.read(CHUNK_HEADER.size)
+        if len(header) < CHUNK_HEADER.size:
+            return
+        count, length = CHUNK_HEADER.unpack(header)
+        if count == 0:
+            return
+        data = fileobj.read(length)
+        if len(data) < length:
+            return
+        yield decode_chunk(data, count, meta['pixel_count'], dtype, meta['compressor'])
+
+
+class SpectrumDecoder:
+    '''
+    Reads a stream written by SpectrumEncoder from a seekable file object.
+    Iterating yields decoded chunks in order while the file is read sequentially,
+    decoder[i] and decoder[a:b] decode only the chunks holding the requested frames.
+    Streams cut short (encoder not closed) are indexed by scanning the chunk headers
+    '''
+
+    def __init__(self, fileobj) -> None:
+        super().__init__()
+        self.fileobj = fileobj
+        fileobj.seek(0)
+        meta, self._data_offset = _read_meta(fileobj)
+        self.pixel_count = meta['pixel_count']
+        self.dtype = np.dtype(meta['dtype'])
+        self.compressor = meta['compressor']
+        self.chunk_frames = meta['chunk_frames']
+        self._offsets, self._counts = self._read_index()
+        self._starts = np.concatenate(([0], np.cumsum(self._counts, dtype=np.int64)))
+        self._cached = (None, None)
+
+    def __len__(self):
+        return int(self._starts[-1])
+
+    def chunk_count(self):
+        return len(self._offsets)
+
+    def read_chunk(self, i):
+        if self._cached[0] == i:
+            return self._cached[1]
+        self.fileobj.seek(self._offsets[i])
+        count, length = CHUNK_HEADER.unpack(self.fileobj.read(CHUNK_HEADER.size))
+        frames = decode_chunk(self.fileobj.read(length), count, self.pixel_count, self.dtype, self.compressor)
+        self._cached = (i, frames)
+        return frames
+
+    def __iter__(self):
+        for i in range(self.chunk_count()):
+            yield self.read_chunk(i)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            indices = np.arange(*item.indices(len(self)))
+            if not len(indices):
+                return np.empty((0, self.pixel_count), dtype=self.dtype)
+            first = int(np.searchsorted(self._starts, indices.min(), 'right')) - 1
+            last = int(np.searchsorted(self._starts, indices.max(), 'right')) - 1
+            frames = np.concatenate([self.read_chunk(i) for i in range(first, last + 1)])
+            return frames[indices - self._starts[first]]
+        index = item + len(self) if item < 0 else item
+        if not 0 <= index < len(self):
+            raise IndexError('Frame %d out of range' % item)
+        chunk = int(np.searchsorted(self._starts, index, 'right')) - 1
+        return self.read_chunk(chunk)[index - self._starts[chunk]]
+
+    def _read_index(self):
+        f = self.fileobj
+        end = f.seek(0, io.SEEK_END)
+        if end >= self._data_offset + FOOTER.size:
+            f.seek(end - FOOTER.size)
+            index_offset, count, magic = FOOTER.unpack(f.read(FOOTER.size))
+            if magic == MAGIC:
+                f.seek(index_offset)
+                entries = [INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size)) for _ in range(count)]
+                return [e[0] for e in entries], [e[1] for e in entries]
+        # no index, walk the complete chunks
+        offsets = []
+        counts = []
+        offset = self._data_offset
+        while offset + CHUNK_HEADER.size <= end:
+            f.seek(offset)
+            count, length = CHUNK_HEADER.unpack(f.read(CHUNK_HEADER.size))
+            if count == 0 or offset + CHUNK_HEADER.size + length > end:
+                break
+            offsets.append(offset)
+            counts.append(count)
+            offset += CHUNK_HEADER.size + length
+        return offsets, counts
@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+import threading
+import uuid
+
+import numpy as np
+
+INDEX_FILE = 'index.json'
+
+
+class DarkFrame:
+    driver = None
+    serial = None
+    exposure_ms = 0.0
+    temperature = None
+    gain = None
+    frame_count = 1
+    file_name = None
+
+    def __init__(self, driver, serial, exposure_ms, temperature, gain, frame_count, file_name) -> None:
+        self.driver = driver
+        self.serial = serial
+        self.exposure_ms = exposure_ms
+        self.temperature = temperature
+        self.gain = gain
+        self.frame_count = frame_count
+        self.file_name = file_name
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['driver'], d['serial'], d['exposure_ms'], d['temperature'], d['gain'], d['frame_count'], d['file_name'])
+
+
+class DarkLibrary:
+    '''
+    On-disk store of averaged dark spectra keyed by driver, serial number, exposure time, gain and sensor temperature.
+    Every dark is a separate .npy file opened memory-mapped on lookup, index.json lists what is stored.
+
+    get() returns the nearest stored dark, or with interpolate set a per pixel linear model
+    dark = a + b * exposure (+ c * temperature) least squares fitted over the nearest darks of the same unit and gain.
+    Distance between darks is relative exposure difference plus temperature difference over temperature_scale 'C
+    '''
+    _log = None
+
+    def __init__(self, root, temperature_scale=1.0) -> None:
+        super().__init__()
+        self.root = root
+        self.temperature_scale = temperature_scale
+        self._log = logging.getLogger('DarkLibrary')
+        self._lock = threading.Lock()
+        self._frames = []
+        self._cache = {}
+        os.makedirs(root, exist_ok=True)
+        index = os.path.join(root, INDEX_FILE)
+        if os.path.exists(index):
+            with open(index) as f:
+                self._frames = [DarkFrame.from_dict(d) for d in json.load(f)]
+
+    # Store a dark, spectra is either a single averaged spectrum or a batch that gets averaged here
+    def add(self, spectra, driver, serial, exposure_ms, temperature=None, gain=None, frame_count=1):
+        data = np.asarray(spectra, dtype=np.float64)
+        if data.ndim == 2:
+            frame_count = len(data)
+            data = data.mean(axis=0)
+        serial = str(serial)
+        file_name = '%s_%s_%s.npy' % (_safe(driver), _safe(serial), uuid.uuid4().hex[:12])
+        np.save(os.path.join(self.root, file_name), data)
+        frame = DarkFrame(driver, serial, float(exposure_ms), temperature, gain, frame_count, file_name)
+        with self._lock:
+            # a dark recorded with identical settings gets replaced
+            replaced = [f for f in self._frames if self._same_settings(f, frame)]
+            self._frames = [f for f in self._frames if f not in replaced] + [frame]
+            self._write_index()
+            for f in replaced:
+                self._cache.pop(f.file_name, None)
+                os.remove(os.path.join(self.root, f.file_name))
+        self._log.debug('Stored dark %s', file_name)
+        return frame
+
+    def frames(self, driver=None, serial=None, gain=None):
+        with self._lock:
+            return [f for f in self._frames
+                    if (driver is None or f.driver == driver) and (serial is None or f.serial == str(serial))
+                    and (gain is None or f.gain == gain)]
+
+    # memory-mapped, read-only dark data
+    def load(self, frame):
+        data = self._cache.get(frame.file_name)
+        if data is None:
+            data = np.load(os.path.join(self.root, frame.file_name), mmap_mode='r')
+            self._cache[frame.file_name] = data
+        return data
+
+    # stored darks of the unit ordered by distance from requested settings
+    def nearest(self, driver, serial, exposure_ms, temperature=None, gain=None, count=1):
+        candidates = [f for f in self.frames(driver, serial) if f.gain == gain]
+        candidates.sort(key=lambda f: self._distance(f, exposure_ms, temperature))
+        return candidates[:count]
+
+    # Returns a dark spectrum for requested settings or None if the library has none for the unit
+    def get(self, driver, serial, exposure_ms, temperature=None, gain=None, interpolate=True, neighbours=4):
+        candidates = self.nearest(driver, serial, exposure_ms, temperature, gain, neighbours if interpolate else 1)
+        if not candidates:
+            return None
+        best = candidates[0]
+        if not interpolate or len(candidates) < 2 or self._distance(best, exposure_ms, temperature) == 0:
+            return self.load(best)
+        columns = [np.ones(len(candidates))]
+        query = [1.0]
+        exposures = np.array([f.exposure_ms for f in candidates])
+        if np.ptp(exposures) > 0:
+            columns.append(exposures)
+            query.append(exposure_ms)
+        if temperature is not None and all(f.temperature is not None for f in candidates):
+            temperatures = np.array([f.temperature for f in candidates], dtype=np.float64)
+            if np.ptp(temperatures) > 0:
+                columns.append(temperatures)
+                query.append(temperature)
+        design = np.column_stack(columns)
+        if np.linalg.matrix_rank(design) < design.shape[1] or len(query) == 1:
+            return self.load(best)
+        darks = np.stack([self.load(f) for f in candidates])
+        coeffs = np.linalg.lstsq(design, darks, rcond=None)[0]
+        return np.asarray(query) @ coeffs
+
+    def _distance(self, frame, exposure_ms, temperature):
+        d = abs(frame.exposure_ms - exposure_ms) / max(frame.exposure_ms, exposure_ms, 1e-12)
+        if temperature is not None and frame.temperature is not None:
+            d += abs(frame.temperature - temperature) / self.temperature_scale
+        return d
+
+    def _same_settings(self, a, b):
+        return (a.driver, a.serial, a.exposure_ms, a.temperature, a.gain) == \
+            (b.driver, b.serial, b.exposure_ms, b.temperature, b.gain)
+
+    def _write_index(self):
+        path = os.path.join(self.root, INDEX_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump([frame.to_dict() for frame in self._frames], f, indent=1)
+        os.replace(path + '.tmp', path)
+
+
+def _safe(name):
+    return ''.join(c if c.isalnum() or c in '-.' else '_' for c in str(name))
@@ -2,7 +2,7 @@ import logging
 import math
 from textwrap import wrap
 
-from vm_proto_gui.pydevices.instrument.spectrometer.spectrometer_base import SpectrometerBase
+from ...spectrometer_base import SpectrometerBase
 
 SN_REG_ADDR = 1
 HW_VER_REG_ADDR = 2
@@ -210,36 +210,43 @@ class Spectrometer(SpectrometerBase):
     '''
     def get_spectrum(self, use_correction=True):
         spectrum = []
+        # with a readout configuration transfer stops at the end of the ROI
+        first = self.readout.first if self.readout is not None else 0
+        stop = self.readout.stop if self.readout is not None else self.pixelCount
 
         # in continuous read spidev driver reads in some garbage and after reading all pixels
         # spectrometer signals that there's more data available,
         # so we have to wait for each byte read into FPGA image buffer
         # signalled by pulling the DATA_READY pin up
-        while len(spectrum) < self.pixelCount:
+        while len(spectrum) < stop:
             # if self.gpioReadPinFn() == 1:
             data = self.readDataFn(2)
             val = mergeBytes(data)
 
-            if use_correction:
+            if use_correction and len(spectrum) >= first:
                 # calculate correction factor, should be 1 or less
-                C = (self.linCalCoeffs['A'] +
-                    self.linCalCoeffs['B1'] * val +
-                    self.linCalCoeffs['B2'] * val +
-                    self.linCalCoeffs['B3'] * val +
-                    self.linCalCoeffs['B4'] * val +
-                    self.linCalCoeffs['B5'] * val +
-                    self.linCalCoeffs['B6'] * val +
-                    self.linCalCoeffs['B7'] * val)
+                C = self.linCalCoeffs['A']
+                for i in range(1, 8):
+                    C += self.linCalCoeffs['B' + str(i)] * val ** i
                 # apply correction factor
                 correctedVal = val / C
                 spectrum.append(correctedVal)
             else:
                 spectrum.append(val)
+        if self.readout is not None:
+            # drop the pixels past the ROI still waiting in the image buffer
+            self.softResetBuf()
+            return list(self.readout.bin(spectrum[first:]))
         return spectrum
 
     def get_pixel_to_wl_mapping(self):
         return self.waveLengthList
 
+    def get_readout_wavelengths(self):
+        if self.readout is None:
+            return self.waveLengthList
+        return list(self.readout.wavelengths(self.waveLengthList))
+
     def printInfo(self):
         serNo = self.getSerialNo()
         if serNo == 0:
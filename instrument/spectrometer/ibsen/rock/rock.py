@@ -3,7 +3,8 @@ from enum import Enum
 
 import time
 
-from vm_proto_gui.pydevices.instrument.spectrometer.spectrometer_base import SpectrometerBase
+from ...spectrometer_base import SpectrometerBase
+from ...tec_settle import SettleMonitor
 
 ACK = 0x06
 NAK = 0x15
@@ -107,14 +108,8 @@ class Spectrometer(SpectrometerBase):
                 # wait for bell
                 b = self._read_fn(1)
                 if (b == b'\x07'):
-                    spec = []
-                    # for i in range(self.pixel_count):
-                    # pixel_value = self._read_fn(6000)
-                    #     pixel_value = self._read_fn(0)
                     data = self._read_fn(6000)
-                    spec = [int(x) for x in data.split()]
-                        # spec.append(pixel_value)
-                    return spec
+                    return self._parse_ascii(data)
                 # else:
                 #     print("Got some crap")
         else:
@@ -122,8 +117,15 @@ class Spectrometer(SpectrometerBase):
 
     def fetch_last(self, type, format):
         data = self._exchange('FETCH:{} {}'.format(type.value, format.value), 6000)
-        spec = [int(x) for x in data.split()]
-        return spec
+        return self._parse_ascii(data)
+
+    # device always sends all pixels, with a readout configuration only the ROI gets converted
+    def _parse_ascii(self, data):
+        values = data.split()
+        if self.readout is None:
+            return [int(x) for x in values]
+        roi = [int(x) for x in values[self.readout.first:self.readout.stop]]
+        return list(self.readout.bin(roi))
 
     def get_spectrum(self, integration_time):
         self.capture(CaptureType.LIGHT, integration_time, 1, OutputFormat.ASCII_W_SPACES)
@@ -185,6 +187,14 @@ class TECController:
     def get_tec_type(self):
         return TECController.TECtype(int(self._exchange_with_trim('para:tectype?')))
 
+    # TEC does not report its setpoint or status, so without a setpoint
+    # temperature is considered settled once it stops drifting out of the tolerance band.
+    # Returns a Future, see SettleMonitor
+    def settle(self, setpoint=None, tolerance=0.1, hold_time=10.0, timeout=600.0, callback=None):
+        monitor = SettleMonitor(self.read_temp, setpoint, tolerance, hold_time, timeout,
+                                callback=callback, name='IbsenRockTEC')
+        return monitor.start()
+
     def _exchange_with_trim(self, out, in_size=def_char_count):
         r = self._exchange(out, in_size)
         result = r.split('\t')[1].strip()
@@ -2,7 +2,7 @@ import logging
 
 from serial import Serial, time
 
-from devices.instrument.spectrometer.ibsen.rock.rock import TECController
+from instrument.spectrometer.ibsen.rock.rock import TECController
 
 logger = logging.getLogger()
 logging.basicConfig(level=logging.DEBUG)
@@ -5,7 +5,7 @@ from serial import Serial, time
 
 import matplotlib.pyplot as plt
 
-from vm_proto_gui.pydevices.instrument.spectrometer.ibsen.rock.rock import Spectrometer, OutputFormat, CaptureType
+from instrument.spectrometer.ibsen.rock.rock import Spectrometer, OutputFormat, CaptureType
 
 logger = logging.getLogger()
 logging.basicConfig(level=logging.DEBUG)
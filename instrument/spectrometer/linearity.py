@@ -0,0 +1,161 @@
+import numpy as np
+
+from .pipeline import LinearityCorrection, Stage
+
+FACTOR = 'factor'  # corrected = raw / poly(raw), Freedom and Qred style
+DIRECT = 'direct'  # corrected = poly(raw) without constant term, SpectrometerBase style
+
+MAX_DEGREE = 7  # most coefficients any of the drivers stores
+
+
+class LinearityLut(Stage):
+    '''
+    Correction precomputed over raw levels 0..max_value. Integer raw data with one level per count
+    is corrected by indexing, anything else by linear interpolation between levels
+    '''
+    name = 'linearity_lut'
+
+    def __init__(self, grid, table) -> None:
+        super().__init__()
+        self.grid = np.asarray(grid, dtype=np.float64)
+        self.table = np.asarray(table, dtype=np.float64)
+        self._direct = self.grid[0] == 0 and np.all(np.diff(self.grid) == 1)
+
+    def process(self, batch):
+        if self._direct and np.issubdtype(np.asarray(batch).dtype, np.integer):
+            return self.table[np.clip(batch, 0, len(self.table) - 1)]
+        return np.interp(batch, self.grid, self.table)
+
+
+class LinearityFit:
+    '''
+    Fitted response correction. coefficients are in increasing order of raw counts starting at power 0,
+    shape (degree + 1,) for a global fit or (degree + 1, pixels) per pixel.
+    rate is the fitted linear signal rate per pixel (counts per exposure unit), rms the relative residual
+    '''
+
+    def __init__(self, coefficients, form, saturation, rate, rms) -> None:
+        super().__init__()
+        self.coefficients = coefficients
+        self.form = form
+        self.saturation = saturation
+        self.rate = rate
+        self.rms = rms
+
+    def is_per_pixel(self):
+        return self.coefficients.ndim == 2
+
+    def stage(self):
+        return LinearityCorrection(self.coefficients, divide=self.form == FACTOR)
+
+    def correct(self, raw):
+        return self.stage().process(np.array(raw, dtype=np.float64, ndmin=2))
+
+    # for SpectrometerBase.linear_calibration_coefficients
+    def to_base_coefficients(self):
+        c = self._global_coefficients(DIRECT)
+        return {'B%d' % i: float(c[i]) if i < len(c) else 0.0 for i in range(1, MAX_DEGREE + 1)}
+
+    # for Freedom linCalCoeffs
+    def to_freedom_coefficients(self):
+        c = self._global_coefficients(FACTOR)
+        coeffs = {'A': float(c[0])}
+        coeffs.update({'B%d' % i: float(c[i]) if i < len(c) else 0.0 for i in range(1, MAX_DEGREE + 1)})
+        return coeffs
+
+    # same layout as Qred get_nonlinearity_coefficients()
+    def to_qred_coefficients(self):
+        return tuple(float(c) for c in self._global_coefficients(FACTOR))
+
+    def lut(self, levels=None):
+        if self.is_per_pixel():
+            raise ValueError('Lookup table needs a global fit')
+        if levels is None:
+            levels = min(int(self.saturation) + 1, 65536)
+        grid = np.linspace(0, self.saturation, levels)
+        if levels == int(self.saturation) + 1:
+            grid = np.arange(levels, dtype=np.float64)
+        return LinearityLut(grid, self.correct(grid)[0])
+
+    def _global_coefficients(self, form):
+        if self.form != form:
+            raise ValueError('Coefficients were fitted as %s, not %s' % (self.form, form))
+        if self.is_per_pixel():
+            raise ValueError('Driver coefficients need a global fit')
+        return self.coefficients
+
+
+# Fit a response correction from spectra of a stable source at several exposure times.
+# spectra is (exposures x pixels), or (exposures x frames x pixels) which gets averaged over frames,
+# dark a single dark spectrum or one per exposure. Points below linear_limit of saturation give
+# every pixel's signal rate, points up to max_level of saturation are used for the polynomial fit
+def fit_linearity(spectra, exposures, dark=None, degree=3, per_pixel=False, form=FACTOR, saturation=None,
+                  linear_limit=0.2, max_level=0.95):
+    if not 1 <= degree <= MAX_DEGREE:
+        raise ValueError('Degree has to be between 1 and %d' % MAX_DEGREE)
+    if form not in (FACTOR, DIRECT):
+        raise ValueError('Unknown correction form %s' % form)
+    m = np.asarray(spectra, dtype=np.float64)
+    if m.ndim == 3:
+        m = m.mean(axis=1)
+    t = np.asarray(exposures, dtype=np.float64)[:, np.newaxis]
+    if len(t) != len(m):
+        raise ValueError('Got %d exposure times for %d spectra' % (len(t), len(m)))
+    if dark is not None:
+        m = m - np.asarray(dark, dtype=np.float64)
+    saturation = float(saturation if saturation is not None else m.max())
+
+    valid = (m > 0) & (m < max_level * saturation)
+    linear = (valid & (m < linear_limit * saturation)).astype(np.float64)
+    # signal rate through the origin from the linear part of every pixel's response
+    denominator = (linear * t * t).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rate = np.where(denominator > 0, (linear * t * m).sum(axis=0) / denominator, np.nan)
+    ideal = rate * t
+    usable = valid & np.isfinite(ideal) & (ideal > 0)
+    ideal = np.where(usable, ideal, 1.0)
+
+    # fit on raw counts scaled to 0..1 for conditioning
+    x = m / saturation
+    if form == FACTOR:
+        powers = np.arange(0, degree + 1)
+        y = m / ideal
+    else:
+        powers = np.arange(1, degree + 1)
+        y = ideal / saturation
+    w = usable.astype(np.float64)
+    design = x[..., np.newaxis] ** powers  # exposures x pixels x terms
+    identity = (powers == (0 if form == FACTOR else 1)).astype(np.float64)
+    if per_pixel:
+        # normal equations of all pixels solved as one batch
+        ata = np.einsum('ep,epk,epl->pkl', w, design, design)
+        atb = np.einsum('ep,epk,ep->pk', w, design, y)
+        ok = usable.sum(axis=0) >= len(powers)
+        scaled = np.tile(identity, (m.shape[1], 1))
+        if ok.any():
+            scaled[ok] = np.einsum('pkl,pl->pk', np.linalg.pinv(ata[ok]), atb[ok])
+        predicted = np.einsum('epk,pk->ep', design, scaled)
+        scaled = scaled.T
+    else:
+        if usable.sum() < len(powers):
+            raise ValueError('Not enough points below saturation for a degree %d fit' % degree)
+        scaled = np.linalg.lstsq(design[usable], y[usable], rcond=None)[0]
+        predicted = design @ scaled
+    residual = (predicted - y)[usable] / (y[usable] if form == DIRECT else 1.0)
+    rms = float(np.sqrt(np.mean(residual ** 2))) if residual.size else 0.0
+
+    # The linear part is never quite linear, so the rate comes out a little low. Lowest order term
+    # is the response at zero signal, normalizing it to 1 corrects the rate as well
+    gain = scaled[0]
+    scaled = scaled / gain
+    rate = rate * gain if form == FACTOR else rate / gain
+
+    # back to raw counts: c_k * x^k = c_k / saturation^k * raw^k
+    scale = saturation ** -powers.astype(np.float64)
+    if form == DIRECT:
+        scale = scale * saturation
+    shape = (-1,) + (1,) * (scaled.ndim - 1)
+    coefficients = scaled * scale.reshape(shape)
+    if form == DIRECT:
+        coefficients = np.concatenate((np.zeros((1,) + coefficients.shape[1:]), coefficients))
+    return LinearityFit(coefficients, form, saturation, rate, rms)
@@ -0,0 +1,123 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+PARABOLIC = 'parabolic'
+GAUSSIAN = 'gaussian'
+CENTROID = 'centroid'
+
+
+class PeakList:
+    frame = None  # row in the batch
+    pixel = None  # pixel of the local maximum
+    position = None  # sub-pixel position
+    height = None
+    wavelength = None  # only with pixel mapping given
+
+    def __init__(self, frame, pixel, position, height, wavelength=None) -> None:
+        self.frame = frame
+        self.pixel = pixel
+        self.position = position
+        self.height = height
+        self.wavelength = wavelength
+
+    def __len__(self):
+        return len(self.pixel)
+
+
+# Local maxima above threshold in every row of the batch, returns (rows, pixels).
+# A maximum has to be the largest value within min_distance pixels on either side
+def find_local_maxima(batch, threshold, min_distance=1):
+    batch = np.atleast_2d(batch)
+    padded = np.pad(batch, ((0, 0), (min_distance, min_distance)), constant_values=-np.inf)
+    window_max = sliding_window_view(padded, 2 * min_distance + 1, axis=1).max(axis=-1)
+    is_peak = (batch >= window_max) & (batch > threshold)
+    # plateaus: keep only the first pixel
+    is_peak[:, 1:] &= batch[:, 1:] != batch[:, :-1]
+    return np.nonzero(is_peak)
+
+
+# values around (row, pixel) pairs as (M x 2*half_width+1), indices clipped at the row edges
+def _windows(batch, rows, pixels, half_width):
+    offsets = np.arange(-half_width, half_width + 1)
+    cols = np.clip(pixels[:, np.newaxis] + offsets, 0, batch.shape[1] - 1)
+    return batch[rows[:, np.newaxis], cols]
+
+
+# sub-pixel position and height of peaks at (rows, pixels)
+def refine(batch, rows, pixels, method=PARABOLIC, half_width=2):
+    batch = np.atleast_2d(batch)
+    rows = np.asarray(rows, dtype=np.intp)
+    pixels = np.asarray(pixels, dtype=np.intp)
+    if method == CENTROID:
+        w = _windows(batch, rows, pixels, half_width)
+        w = w - w.min(axis=1, keepdims=True)
+        total = w.sum(axis=1)
+        offsets = np.arange(-half_width, half_width + 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = np.where(total > 0, (w * offsets).sum(axis=1) / total, 0.0)
+        return pixels + delta, batch[rows, pixels]
+    w = _windows(batch, rows, pixels, 1).astype(np.float64)
+    if method == GAUSSIAN:
+        w = np.log(np.maximum(w, np.finfo(np.float64).tiny))
+    elif method != PARABOLIC:
+        raise ValueError('Unknown refinement method %s' % method)
+    left, centre, right = w[:, 0], w[:, 1], w[:, 2]
+    curvature = left - 2 * centre + right
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = np.where(curvature < 0, 0.5 * (left - right) / curvature, 0.0)
+    delta = np.clip(delta, -0.5, 0.5)
+    height = centre - 0.25 * (left - right) * delta
+    if method == GAUSSIAN:
+        height = np.exp(height)
+    return pixels + delta, height
+
+
+# fractional pixel positions to wavelengths through the pixel to wavelength mapping
+def to_wavelength(positions, mapping):
+    mapping = np.asarray(mapping, dtype=np.float64)
+    return np.interp(positions, np.arange(len(mapping)), mapping)
+
+
+def find_peaks(batch, threshold, min_distance=1, method=PARABOLIC, half_width=2, mapping=None):
+    batch = np.atleast_2d(batch)
+    rows, pixels = find_local_maxima(batch, threshold, min_distance)
+    position, height = refine(batch, rows, pixels, method, half_width)
+    wavelength = to_wavelength(position, mapping) if mapping is not None else None
+    return PeakList(rows, pixels, position, height, wavelength)
+
+
+class PeakTracker:
+    '''
+    Follows known peaks from frame to frame. For every new batch only windows of +/-search pixels around
+    the last known positions are examined: maximum within the window gets refined and becomes the new position.
+    update() returns (N x peak count) positions (and wavelengths with mapping given)
+    '''
+
+    def __init__(self, positions, search=3, method=PARABOLIC, half_width=2, mapping=None) -> None:
+        super().__init__()
+        self.positions = np.asarray(positions, dtype=np.float64)
+        self.search = search
+        self.method = method
+        self.half_width = half_width
+        self.mapping = mapping
+        self.heights = None
+
+    @classmethod
+    def from_frame(cls, spectrum, threshold, min_distance=1, **kwargs):
+        peaks = find_peaks(spectrum, threshold, min_distance, kwargs.get('method', PARABOLIC), kwargs.get('half_width', 2))
+        return cls(peaks.position, **kwargs)
+
+    def update(self, batch):
+        batch = np.atleast_2d(batch)
+        n, k = len(batch), len(self.positions)
+        centres = np.rint(self.positions).astype(np.intp)
+        rows = np.repeat(np.arange(n), k)
+        windows = _windows(batch, rows, np.tile(centres, n), self.search)
+        pixels = np.clip(np.tile(centres, n) + windows.argmax(axis=1) - self.search, 0, batch.shape[1] - 1)
+        position, height = refine(batch, rows, pixels, self.method, self.half_width)
+        position = position.reshape(n, k)
+        self.positions = position[-1].copy()
+        self.heights = height.reshape(n, k)
+        if self.mapping is not None:
+            return position, to_wavelength(position, self.mapping)
+        return position
@@ -0,0 +1,278 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+from .resample import LINEAR, linear_matrix, rebin_matrix
+
+
+# Spectra from any driver (qred Spectrum, list/tuple of pixel values, list of those or an array)
+# as a 2-D float batch with one spectrum per row. Without copy an array of matching dtype is used as is
+def as_batch(data, dtype=np.float64, copy=False):
+    if hasattr(data, 'amplitudes'):
+        data = data.amplitudes
+    elif isinstance(data, (list, tuple)) and len(data) and hasattr(data[0], 'amplitudes'):
+        data = [s.amplitudes for s in data]
+    if copy:
+        return np.atleast_2d(np.array(data, dtype=dtype))
+    return np.atleast_2d(np.asarray(data, dtype=dtype))
+
+
+class Stage:
+    '''
+    Single processing step, process() takes a 2-D batch and returns the processed batch.
+    Stages may modify the batch in place and may return fewer rows than received (even none)
+    '''
+    name = 'Stage'
+
+    def process(self, batch):
+        raise NotImplementedError
+
+    def __call__(self, batch):
+        return self.process(batch)
+
+
+class DarkSubtract(Stage):
+    name = 'dark'
+
+    def __init__(self, dark) -> None:
+        super().__init__()
+        self.dark = np.asarray(dark, dtype=np.float64)
+
+    def process(self, batch):
+        batch -= self.dark
+        return batch
+
+
+class LinearityCorrection(Stage):
+    '''
+    Polynomial response correction, coefficients are in increasing order (c0 + c1*x + c2*x^2 ...).
+    If divide is set, polynomial gives a correction factor and output is x / poly(x),
+    otherwise output is poly(x) directly
+    '''
+    name = 'linearity'
+
+    def __init__(self, coefficients, divide=False) -> None:
+        super().__init__()
+        self.coefficients = np.asarray(coefficients, dtype=np.float64)
+        self.divide = divide
+
+    # SpectrometerBase.linear_calibration_coefficients style {'B1': .., 'B7': ..}
+    @classmethod
+    def from_base_coefficients(cls, coeffs):
+        return cls([0.0] + [coeffs.get('B%d' % i, 0.0) for i in range(1, 8)])
+
+    # Freedom linCalCoeffs style {'A': .., 'B1': ..}, a correction factor to divide by
+    @classmethod
+    def from_freedom_coefficients(cls, coeffs):
+        return cls([coeffs.get('A', 1.0)] + [coeffs.get('B%d' % i, 0.0) for i in range(1, 8)], divide=True)
+
+    def process(self, batch):
+        # Horner's scheme, no temporary powers of the whole batch
+        poly = np.full_like(batch, self.coefficients[-1])
+        for c in self.coefficients[-2::-1]:
+            poly *= batch
+            poly += c
+        if self.divide:
+            batch /= poly
+            return batch
+        return poly
+
+
+class BadPixelFix(Stage):
+    name = 'bad_pixels'
+
+    # pixel_map is a PixelMap, see pixel_correction
+    def __init__(self, pixel_map) -> None:
+        super().__init__()
+        self.pixel_map = pixel_map
+
+    def process(self, batch):
+        return self.pixel_map.apply(batch)
+
+
+class CoAdd(Stage):
+    '''
+    Sums (or averages) every count consecutive spectra into one.
+    Leftover spectra are kept until the next batch completes the group
+    '''
+    name = 'coadd'
+
+    def __init__(self, count, average=True) -> None:
+        super().__init__()
+        if count < 1:
+            raise ValueError('Co-add count has to be at least 1')
+        self.count = count
+        self.average = average
+        self._pending = None
+
+    def process(self, batch):
+        if self._pending is not None and len(self._pending):
+            batch = np.concatenate((self._pending, batch))
+        groups = len(batch) // self.count
+        self._pending = batch[groups * self.count:].copy()
+        out = batch[:groups * self.count].reshape(groups, self.count, batch.shape[1]).sum(axis=1)
+        if self.average:
+            out /= self.count
+        return out
+
+
+class Resample(Stage):
+    '''
+    Resampling from source wavelengths onto target wavelengths (both ascending) through a precomputed
+    sparse matrix, see resample module for modes. Target points outside the source range are set to NaN
+    '''
+    name = 'resample'
+
+    def __init__(self, source_wavelengths, target_wavelengths, mode=LINEAR) -> None:
+        super().__init__()
+        if mode == LINEAR:
+            self.matrix = linear_matrix(source_wavelengths, target_wavelengths)
+        else:
+            self.matrix = rebin_matrix(source_wavelengths, target_wavelengths, mode)
+
+    def process(self, batch):
+        return self.matrix.apply(batch)
+
+
+class Crop(Stage):
+    name = 'crop'
+
+    # keeps pixels [first, last), returned batch is a view
+    def __init__(self, first, last) -> None:
+        super().__init__()
+        self.first = first
+        self.last = last
+
+    # crop to a wavelength range given pixel to wavelength mapping
+    @classmethod
+    def from_wavelengths(cls, wavelengths, wl_min, wl_max):
+        wl = np.asarray(wavelengths)
+        idx = np.flatnonzero((wl >= wl_min) & (wl <= wl_max))
+        if not len(idx):
+            raise ValueError('No pixels within %f - %f nm' % (wl_min, wl_max))
+        return cls(int(idx[0]), int(idx[-1]) + 1)
+
+    def process(self, batch):
+        return batch[:, self.first:self.last]
+
+
+class StageTimes:
+    calls = 0
+    frames = 0
+    seconds = 0.0
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.frames = 0
+        self.seconds = 0.0
+
+
+def _run_stages(stages, batch):
+    times = []
+    for stage in stages:
+        frames = len(batch)
+        start = time.perf_counter()
+        batch = stage.process(batch)
+        times.append((frames, time.perf_counter() - start))
+    return batch, times
+
+
+class Pipeline:
+    '''
+    Chain of stages over batches of spectra.
+    process() runs synchronously in the calling thread, submit() hands the batch to an executor
+    (by default a single worker thread, which keeps output order and stage state consistent).
+    Stateful stages (CoAdd) in a process pool work on per-process copies of their state.
+    Time spent in every stage is accumulated, see get_stage_times()
+    Input is copied, unless copy is False in which case float arrays of matching dtype get modified in place
+    '''
+    _log = None
+
+    def __init__(self, stages, executor=None, dtype=np.float64, copy=True) -> None:
+        super().__init__()
+        self.stages = list(stages)
+        self.dtype = dtype
+        self.copy = copy
+        self._executor = executor
+        self._own_executor = False
+        self._times = [StageTimes() for _ in self.stages]
+        self._lock = threading.Lock()
+        self._log = logging.getLogger('Pipeline')
+
+    def process(self, data):
+        batch, times = _run_stages(self.stages, as_batch(data, self.dtype, self.copy))
+        self._add_times(times)
+        return batch
+
+    # returns a Future of the processed batch
+    def submit(self, data):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='Pipeline')
+            self._own_executor = True
+        future = self._executor.submit(_run_stages, self.stages, as_batch(data, self.dtype, self.copy))
+        result = Future()
+
+        def done(f):
+            if f.cancelled():
+                result.cancel()
+                result.set_running_or_notify_cancel()
+                return
+            if f.exception() is not None:
+                result.set_exception(f.exception())
+                return
+            batch, times = f.result()
+            self._add_times(times)
+            result.set_result(batch)
+        future.add_done_callback(done)
+        return result
+
+    # processes batches from source, yields results in order.
+    # With an executor up to max_pending batches are processed concurrently with the producer
+    def stream(self, source, max_pending=4):
+        if self._executor is None:
+            for data in source:
+                yield self.process(data)
+            return
+        pending = deque()
+        for data in source:
+            pending.append(self.submit(data))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    # feed batches from source into sink(batch) on a background thread, returns the thread
+    def run_in_background(self, source, sink):
+        def run():
+            for batch in self.stream(source):
+                sink(batch)
+        thread = threading.Thread(target=run, name='Pipeline', daemon=True)
+        thread.start()
+        return thread
+
+    # {'stage name#index': StageTimes}, indexed so stages of the same class are kept apart
+    def get_stage_times(self):
+        with self._lock:
+            return {'%s#%d' % (stage.name, i): t for i, (stage, t) in enumerate(zip(self.stages, self._times))}
+
+    def log_stage_times(self):
+        for name, t in self.get_stage_times().items():
+            per_frame = t.seconds / t.frames * 1e6 if t.frames else 0.0
+            self._log.info('%s: %d calls, %d frames, %.3f s total, %.1f us/frame', name, t.calls, t.frames, t.seconds, per_frame)
+
+    def shutdown(self):
+        if self._own_executor:
+            self._executor.shutdown()
+            self._executor = None
+            self._own_executor = False
+
+    def _add_times(self, times):
+        with self._lock:
+            for acc, (frames, seconds) in zip(self._times, times):
+                acc.calls += 1
+                acc.frames += frames
+                acc.seconds += seconds
@@ -0,0 +1,77 @@
+import numpy as np
+
+
+class PixelMap:
+    '''
+    Precomputed pixel bookkeeping of a sensor, applied to whole (N x width) batches at once:
+    - bad pixels get replaced by linear interpolation between nearest good optical neighbours
+    - mean of dark pixels (or offset pixels if no dark ones) in every row is the offset to subtract
+    - dark and offset pixels are not optical and get stripped from the output
+    Indices are relative to a spectrum row as returned by the driver, ones outside the row are ignored
+    '''
+
+    def __init__(self, width, bad_pixels=(), dark_pixels=(), offset_pixels=()) -> None:
+        super().__init__()
+        self.width = width
+        self.dark_pixels = self._valid(dark_pixels)
+        self.offset_pixels = self._valid(offset_pixels)
+        non_optical = np.zeros(width, dtype=bool)
+        non_optical[self.dark_pixels] = True
+        non_optical[self.offset_pixels] = True
+        optical = np.flatnonzero(~non_optical)
+        # contiguous optical range can be stripped with a view instead of a copy
+        if len(optical) and optical[-1] - optical[0] + 1 == len(optical):
+            self.optical = slice(int(optical[0]), int(optical[-1]) + 1)
+        else:
+            self.optical = optical
+        self.optical_count = len(optical)
+        bad = self._valid(bad_pixels)
+        reference = self.dark_pixels if len(self.dark_pixels) else self.offset_pixels
+        self.reference_pixels = np.setdiff1d(reference, bad)
+
+        self.bad_pixels = bad[~non_optical[bad]]
+        good = ~non_optical
+        good[self.bad_pixels] = False
+        good_idx = np.flatnonzero(good)
+        if len(self.bad_pixels) and not len(good_idx):
+            raise ValueError('No good pixels to interpolate from')
+        # nearest good neighbour on either side of every bad pixel and the interpolation weight of the right one,
+        # at the edges both neighbours end up the same pixel, which then simply gets copied
+        pos = np.searchsorted(good_idx, self.bad_pixels)
+        self._left = good_idx[np.clip(pos - 1, 0, len(good_idx) - 1)] if len(good_idx) else pos
+        self._right = good_idx[np.clip(pos, 0, len(good_idx) - 1)] if len(good_idx) else pos
+        span = self._right - self._left
+        self._weight = np.where(span > 0, (self.bad_pixels - self._left) / np.maximum(span, 1), 0.0)
+
+    def _valid(self, indices):
+        indices = np.unique(np.asarray(indices, dtype=np.intp))
+        return indices[(indices >= 0) & (indices < self.width)]
+
+    # interpolate bad pixels in place
+    def fix_bad_pixels(self, batch):
+        if len(self.bad_pixels):
+            left = batch[:, self._left]
+            batch[:, self.bad_pixels] = left + (batch[:, self._right] - left) * self._weight
+        return batch
+
+    # per row offset level from dark (or offset) pixels, zeros if the sensor has none
+    def dark_level(self, batch):
+        if not len(self.reference_pixels):
+            return np.zeros(len(batch), dtype=batch.dtype)
+        return batch[:, self.reference_pixels].mean(axis=1)
+
+    # subtract the dark level in place
+    def subtract_dark(self, batch):
+        if len(self.reference_pixels):
+            batch -= self.dark_level(batch)[:, np.newaxis]
+        return batch
+
+    def strip(self, batch):
+        return batch[:, self.optical]
+
+    # full correction of a float batch (modified in place), returns optical pixels only
+    def apply(self, batch):
+        batch = np.atleast_2d(batch)
+        self.subtract_dark(batch)
+        self.fix_bad_pixels(batch)
+        return self.strip(batch)
@@ -0,0 +1,51 @@
+import numpy as np
+
+
+class ReadoutConfig:
+    '''
+    Region of interest and binning applied to spectra right at readout.
+    Pixels [first, last) are kept, every binning adjacent pixels are summed (or averaged) into one,
+    an incomplete bin at the end of the region is dropped. Cropping works on views of the raw buffer,
+    so with binning 1 nothing is copied unless an output array is given
+    '''
+
+    def __init__(self, pixel_count, first=0, last=None, binning=1, average=False) -> None:
+        super().__init__()
+        if last is None:
+            last = pixel_count
+        if not 0 <= first < last <= pixel_count:
+            raise ValueError('Invalid pixel range %d..%d for %d pixels' % (first, last, pixel_count))
+        if binning < 1 or binning > last - first:
+            raise ValueError('Invalid binning %d for %d pixels' % (binning, last - first))
+        self.pixel_count = pixel_count
+        self.first = first
+        self.binning = binning
+        self.average = average
+        self.output_count = (last - first) // binning
+        # last raw pixel actually used
+        self.stop = first + self.output_count * binning
+
+    def is_full_frame(self):
+        return self.first == 0 and self.stop == self.pixel_count and self.binning == 1
+
+    # raw spectrum or (N x pixel count) batch -> (..., output_count), written to out if given
+    def apply(self, raw, out=None):
+        return self.bin(np.asarray(raw)[..., self.first:self.stop], out)
+
+    # for drivers that only transfer or convert the region: pixels [first, stop) -> (..., output_count)
+    def bin(self, roi, out=None):
+        roi = np.asarray(roi)
+        if self.binning == 1:
+            if out is None:
+                return roi
+            out[...] = roi
+            return out
+        bins = roi.reshape(roi.shape[:-1] + (self.output_count, self.binning))
+        if self.average:
+            return np.mean(bins, axis=-1, out=out)
+        return np.sum(bins, axis=-1, out=out)
+
+    # pixel to wavelength mapping of the full sensor -> mapping of the output pixels (bin centres)
+    def wavelengths(self, mapping):
+        mapping = np.asarray(mapping, dtype=np.float64)
+        return mapping[self.first:self.stop].reshape(self.output_count, self.binning).mean(axis=1)
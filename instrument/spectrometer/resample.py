@@ -0,0 +1,162 @@
+import threading
+
+import numpy as np
+
+LINEAR = 'linear'
+FLUX = 'flux'  # conserves summed counts, for per pixel integrated signal
+DENSITY = 'density'  # bin average, for spectral densities (per nm) and comparing units with different pixel widths
+
+
+class SparseMatrix:
+    '''
+    Minimal CSR matrix mapping source pixels to target points, apply() is a sparse product over a whole batch.
+    Target points without any source pixel come out as NaN
+    '''
+
+    def __init__(self, indptr, indices, data, shape) -> None:
+        super().__init__()
+        self.indptr = np.asarray(indptr, dtype=np.intp)
+        self.indices = np.asarray(indices, dtype=np.intp)
+        self.data = np.asarray(data, dtype=np.float64)
+        self.shape = shape
+        counts = np.diff(self.indptr)
+        self._covered = counts > 0
+        self._starts = self.indptr[:-1][self._covered]
+
+    # batch (N x source count) -> (N x target count)
+    def apply(self, batch):
+        batch = np.atleast_2d(batch)
+        out = np.full((len(batch), self.shape[0]), np.nan)
+        if len(self.indices):
+            products = batch[:, self.indices] * self.data
+            out[:, self._covered] = np.add.reduceat(products, self._starts, axis=1)
+        return out
+
+    def coverage(self):
+        return self._covered
+
+
+# Source mapping in ascending order and whether it was descending (mirrored spectrum, Rock with negative B1)
+def ascending(source):
+    src = np.asarray(source, dtype=np.float64)
+    step = np.diff(src)
+    if np.all(step > 0):
+        return src, False
+    if np.all(step < 0):
+        return src[::-1], True
+    raise ValueError('Wavelength mapping is not monotonic')
+
+
+# matrix built on the reversed mapping reads the source pixels back to front
+def _mirrored(m):
+    return SparseMatrix(m.indptr, m.shape[1] - 1 - m.indices, m.data, m.shape)
+
+
+# target array is ascending wavelengths, source ascending or descending
+def linear_matrix(source, target):
+    src, reverse = ascending(source)
+    if reverse:
+        return _mirrored(linear_matrix(src, target))
+    dst = np.asarray(target, dtype=np.float64)
+    inside = (dst >= src[0]) & (dst <= src[-1])
+    right = np.clip(np.searchsorted(src, dst), 1, len(src) - 1)
+    left = right - 1
+    weight = (dst - src[left]) / (src[right] - src[left])
+    rows = np.flatnonzero(inside)
+    indices = np.column_stack((left[rows], right[rows])).ravel()
+    data = np.column_stack((1 - weight[rows], weight[rows])).ravel()
+    indptr = np.zeros(len(dst) + 1, dtype=np.intp)
+    indptr[rows + 1] = 2
+    return SparseMatrix(np.cumsum(indptr), indices, data, (len(dst), len(src)))
+
+
+# bin edges halfway between centres, outer edges mirrored
+def bin_edges(centres):
+    c = np.asarray(centres, dtype=np.float64)
+    mid = (c[1:] + c[:-1]) / 2
+    return np.concatenate(([c[0] - (mid[0] - c[0])], mid, [c[-1] + (c[-1] - mid[-1])]))
+
+
+# weights by overlap of source and target pixel bins
+def rebin_matrix(source, target, mode=FLUX):
+    src, reverse = ascending(source)
+    if reverse:
+        return _mirrored(rebin_matrix(src, target, mode))
+    se = bin_edges(src)
+    te = bin_edges(target)
+    # range of source bins overlapping every target bin
+    lo = np.clip(np.searchsorted(se, te[:-1], 'right') - 1, 0, len(se) - 2)
+    hi = np.clip(np.searchsorted(se, te[1:], 'left'), 1, len(se) - 1)
+    counts = np.maximum(hi - lo, 0)
+    rows = np.repeat(np.arange(len(te) - 1), counts)
+    cols = np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    overlap = np.minimum(se[cols + 1], te[rows + 1]) - np.maximum(se[cols], te[rows])
+    keep = overlap > 0
+    rows, cols, overlap = rows[keep], cols[keep], overlap[keep]
+    if mode == FLUX:
+        data = overlap / (se[cols + 1] - se[cols])
+    elif mode == DENSITY:
+        # average over the covered part of the target bin
+        covered = np.bincount(rows, overlap, len(te) - 1)
+        data = overlap / covered[rows]
+    else:
+        raise ValueError('Unknown rebinning mode %s' % mode)
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=len(te) - 1))))
+    return SparseMatrix(indptr, cols, data, (len(te) - 1, len(se) - 1))
+
+
+class Resampler:
+    '''
+    Resamples spectra of several units onto a common wavelength grid.
+    Interpolation matrix is built once per (unit serial, source mapping, mode) and cached,
+    after that every batch is a single sparse product. Descending source mappings are resampled
+    as the reversed mapping with the spectrum read back to front
+    '''
+
+    def __init__(self, target, mode=LINEAR) -> None:
+        super().__init__()
+        self.target = np.asarray(target, dtype=np.float64)
+        self.mode = mode
+        self._matrices = {}
+        self._lock = threading.Lock()
+
+    def matrix(self, serial, source):
+        source, reverse = ascending(source)
+        key = (serial, hash(source.tobytes()), reverse)
+        with self._lock:
+            m = self._matrices.get(key)
+        if m is None:
+            if self.mode == LINEAR:
+                m = linear_matrix(source, self.target)
+            else:
+                m = rebin_matrix(source, self.target, self.mode)
+            if reverse:
+                m = _mirrored(m)
+            with self._lock:
+                self._matrices[key] = m
+        return m
+
+    def resample(self, batch, serial, source):
+        return self.matrix(serial, source).apply(batch)
+
+    # Combine spectra of several units [(batch, serial, source wavelengths), ...] with the same frame count.
+    # In overlapping ranges units are cross-faded, weight of each falls off linearly towards its range edges
+    def stitch(self, inputs):
+        total = None
+        weights = None
+        for batch, serial, source in inputs:
+            resampled = self.resample(batch, serial, source)
+            lo, hi = np.min(source), np.max(source)
+            w = np.clip(np.minimum(self.target - lo, hi - self.target), 0, None)
+            # points exactly on the range edge still count, with minimal weight
+            w = np.where(self.matrix(serial, source).coverage(), np.maximum(w, 1e-9), 0.0)
+            if total is None:
+                total = np.zeros_like(resampled)
+                weights = np.zeros(len(self.target))
+            valid = ~np.isnan(resampled)
+            total += np.where(valid, resampled, 0.0) * w
+            weights += w
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out = total / weights
+        out[:, weights == 0] = np.nan
+        return out
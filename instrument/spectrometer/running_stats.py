@@ -0,0 +1,124 @@
+import threading
+
+import numpy as np
+
+from .pipeline import Stage, as_batch
+
+
+class StatsSnapshot:
+    count = 0
+    mean = None
+    variance = None
+    minimum = None
+    maximum = None
+    saturated = None
+
+    def __init__(self, count, mean, variance, minimum, maximum, saturated) -> None:
+        self.count = count
+        self.mean = mean
+        self.variance = variance
+        self.minimum = minimum
+        self.maximum = maximum
+        self.saturated = saturated
+
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+class RunningStats:
+    '''
+    Per pixel running mean, variance, min, max and saturation count over any number of spectra,
+    memory use does not depend on how many were added.
+    Batches are folded in with Welford/Chan updates in float64.
+    Accumulators filled in different threads or from different devices can be merged.
+    Pixels at or above saturation level (if given) are counted per pixel
+    '''
+
+    def __init__(self, saturation=None) -> None:
+        super().__init__()
+        self.saturation = saturation
+        self.count = 0
+        self._mean = None
+        self._m2 = None
+        self._min = None
+        self._max = None
+        self._saturated = None
+        self._lock = threading.Lock()
+
+    def update(self, data):
+        batch = as_batch(data)
+        n = len(batch)
+        if n == 0:
+            return self
+        mean = batch.mean(axis=0)
+        m2 = ((batch - mean) ** 2).sum(axis=0)
+        saturated = None
+        if self.saturation is not None:
+            saturated = np.count_nonzero(batch >= self.saturation, axis=0)
+        with self._lock:
+            self._combine(n, mean, m2, batch.min(axis=0), batch.max(axis=0), saturated)
+        return self
+
+    # fold other accumulator into this one
+    def merge(self, other):
+        with other._lock:
+            if other.count == 0:
+                return self
+            args = (other.count, other._mean.copy(), other._m2.copy(), other._min.copy(), other._max.copy(),
+                    None if other._saturated is None else other._saturated.copy())
+        with self._lock:
+            self._combine(*args)
+        return self
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self._mean = self._m2 = self._min = self._max = self._saturated = None
+
+    # consistent copy of current state, ddof=1 gives sample variance
+    def snapshot(self, ddof=1):
+        with self._lock:
+            if self.count == 0:
+                raise ValueError('No spectra accumulated')
+            variance = self._m2 / max(self.count - ddof, 1)
+            return StatsSnapshot(self.count, self._mean.copy(), variance, self._min.copy(), self._max.copy(),
+                                 None if self._saturated is None else self._saturated.copy())
+
+    def _combine(self, n, mean, m2, minimum, maximum, saturated):
+        if self.count == 0:
+            self.count = n
+            self._mean = np.array(mean, dtype=np.float64)
+            self._m2 = np.array(m2, dtype=np.float64)
+            self._min = np.array(minimum, dtype=np.float64)
+            self._max = np.array(maximum, dtype=np.float64)
+            if saturated is not None:
+                self._saturated = np.array(saturated, dtype=np.int64)
+            return
+        if len(mean) != len(self._mean):
+            raise ValueError('Pixel count mismatch: %d vs %d' % (len(mean), len(self._mean)))
+        total = self.count + n
+        delta = mean - self._mean
+        self._mean += delta * (n / total)
+        self._m2 += m2 + delta ** 2 * (self.count * n / total)
+        np.minimum(self._min, minimum, out=self._min)
+        np.maximum(self._max, maximum, out=self._max)
+        if saturated is not None:
+            if self._saturated is None:
+                self._saturated = np.zeros(len(self._mean), dtype=np.int64)
+            self._saturated += saturated
+        self.count = total
+
+
+class AccumulateStats(Stage):
+    '''
+    Pass-through pipeline stage feeding every batch into a RunningStats
+    '''
+    name = 'stats'
+
+    def __init__(self, stats=None) -> None:
+        super().__init__()
+        self.stats = stats if stats is not None else RunningStats()
+
+    def process(self, batch):
+        self.stats.update(batch)
+        return batch
@@ -23,6 +23,7 @@ class SpectrometerBase:
     }
     wavelength_list = []
     pixel_count = 0
+    readout = None  # ReadoutConfig applied to captured spectra, None for full frames
 
     def __init__(self, ser_read, ser_write, name="SpectrometerBase") -> None:
         self._write_fn = ser_write
@@ -50,6 +51,22 @@ class SpectrometerBase:
             )
         return self.wavelength_list
 
+    # Keep only pixels [first, last) and combine binning adjacent pixels, see ReadoutConfig.
+    # Called without arguments it goes back to full frames
+    def set_readout(self, first=0, last=None, binning=1, average=False):
+        # readout needs numpy, importing it here keeps the drivers loadable without it
+        from .readout import ReadoutConfig
+        readout = ReadoutConfig(self.get_pixel_count(), first, last, binning, average)
+        self.readout = None if readout.is_full_frame() else readout
+        return readout
+
+    # wavelengths matching the pixels of spectra as returned with the current readout configuration
+    def get_readout_wavelengths(self):
+        mapping = self.get_pixel_to_wavelength_mapping()
+        if self.readout is None:
+            return mapping
+        return list(self.readout.wavelengths(mapping))
+
     def get_serial_number(self):
         raise NotImplementedError
 
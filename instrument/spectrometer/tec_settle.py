@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+
+
+class TECSettleError(Exception):
+    def __init__(self, message, status=None, temperature=None) -> None:
+        super().__init__(message)
+        self.status = status
+        self.temperature = temperature
+
+
+class SettleResult:
+    temperature = None
+    elapsed = 0.0
+    sample_count = 0
+
+    def __init__(self, temperature, elapsed, sample_count) -> None:
+        self.temperature = temperature
+        self.elapsed = elapsed
+        self.sample_count = sample_count
+
+
+class SettleMonitor:
+    '''
+    Watches temperature until it stays within +/-tolerance of the setpoint for hold_time seconds.
+    If setpoint is None, temperature is considered stable once all samples within hold_time fit
+    into the tolerance band, i.e. the temperature has stopped drifting.
+
+    read_temp_fn() has to return the current temperature in 'C
+    read_status_fn(), if given, is polled alongside and any status listed in fault_states fails the wait
+
+    Sampling interval follows the temperature trend: while far from the setpoint it is set to half of
+    the predicted time to reach the band, near the setpoint it drops down to min_interval.
+    Result is delivered through the returned Future (and optional callback(future)),
+    cancel the future to stop monitoring.
+    '''
+    _log = None
+
+    def __init__(self, read_temp_fn, setpoint=None, tolerance=0.1, hold_time=5.0, timeout=600.0,
+                 read_status_fn=None, fault_states=(), min_interval=0.2, max_interval=5.0,
+                 callback=None, name='TECSettle') -> None:
+        super().__init__()
+        if tolerance <= 0:
+            raise ValueError('Tolerance has to be positive')
+        if min_interval <= 0 or max_interval < min_interval:
+            raise ValueError('Bad sampling interval limits')
+        self._read_temp_fn = read_temp_fn
+        self._read_status_fn = read_status_fn
+        self._fault_states = tuple(fault_states)
+        self.setpoint = setpoint
+        self.tolerance = tolerance
+        self.hold_time = hold_time
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._callback = callback
+        self._log = logging.getLogger(name)
+        # (time, temperature) pairs covering at least the hold window, used for trend estimation
+        self._samples = deque()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.future = None
+
+    def start(self) -> Future:
+        if self.future is not None:
+            raise ValueError('Monitor already started')
+        self.future = Future()
+        self.future.add_done_callback(lambda f: self._wakeup.set())
+        if self._callback is not None:
+            self.future.add_done_callback(self._callback)
+        self._thread = threading.Thread(target=self._run, name=self._log.name, daemon=True)
+        self._thread.start()
+        return self.future
+
+    def wait(self):
+        return self.start().result()
+
+    def get_trend(self):
+        # slope of least squares line through recent samples, 'C per second
+        n = len(self._samples)
+        if n < 2:
+            return 0.0
+        t0 = self._samples[0][0]
+        mean_t = sum(t - t0 for t, _ in self._samples) / n
+        mean_v = sum(v for _, v in self._samples) / n
+        num = sum((t - t0 - mean_t) * (v - mean_v) for t, v in self._samples)
+        den = sum((t - t0 - mean_t) ** 2 for t, _ in self._samples)
+        if den == 0:
+            return 0.0
+        return num / den
+
+    def _run(self):
+        try:
+            result = self._monitor()
+        except Exception as e:
+            self._finish(exception=e)
+        else:
+            self._finish(result=result)
+
+    def _finish(self, result=None, exception=None):
+        try:
+            if exception is not None:
+                self.future.set_exception(exception)
+            else:
+                self.future.set_result(result)
+        except InvalidStateError:
+            # cancelled by the caller in the meantime
+            pass
+
+    def _monitor(self):
+        start = time.monotonic()
+        in_band_since = None
+        sample_count = 0
+        while not self.future.cancelled():
+            now = time.monotonic()
+            temp = self._read_temp_fn()
+            sample_count += 1
+            self._add_sample(now, temp)
+            if self._read_status_fn is not None:
+                status = self._read_status_fn()
+                if status in self._fault_states:
+                    self._log.error('TEC fault %s at %3.3f \'C', getattr(status, 'name', status), temp)
+                    raise TECSettleError('TEC reported %s' % getattr(status, 'name', status), status, temp)
+
+            if self._in_band(temp):
+                if in_band_since is None:
+                    in_band_since = now
+                if now - in_band_since >= self.hold_time:
+                    elapsed = now - start
+                    self._log.info('Temperature settled at %3.3f \'C after %.1f s', temp, elapsed)
+                    return SettleResult(temp, elapsed, sample_count)
+            else:
+                in_band_since = None
+
+            if now - start > self.timeout:
+                raise TECSettleError('Temperature did not settle within %.1f s' % self.timeout, None, temp)
+            interval = self._next_interval(temp)
+            self._log.debug('t: %3.3f \'C, trend: %3.4f \'C/s, next sample in %.2f s', temp, self.get_trend(), interval)
+            self._wakeup.wait(interval)
+        return None
+
+    def _add_sample(self, now, temp):
+        self._samples.append((now, temp))
+        # keep one sample older than the hold window, so the window is always fully covered
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self.hold_time:
+            self._samples.popleft()
+
+    def _in_band(self, temp):
+        if self.setpoint is not None:
+            return abs(temp - self.setpoint) <= self.tolerance
+        values = [v for _, v in self._samples]
+        return len(values) > 1 and max(values) - min(values) <= 2 * self.tolerance
+
+    def _next_interval(self, temp):
+        # need a couple of samples before trend means anything
+        if self._in_band(temp) or len(self._samples) < 2:
+            return self.min_interval
+        slope = self.get_trend()
+        if self.setpoint is None:
+            # no target to approach, sample in proportion to how quickly temperature drifts
+            distance = self.tolerance
+        else:
+            distance = abs(temp - self.setpoint) - self.tolerance
+            # moving away from the setpoint or flat, no useful prediction
+            if slope == 0 or (slope > 0) == (temp > self.setpoint):
+                return self.max_interval
+        if slope == 0:
+            return self.max_interval
+        eta = distance / abs(slope)
+        return min(self.max_interval, max(self.min_interval, eta / 2))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import io
+import time
+
+import numpy as np
+
+from instrument.spectrometer.codec import LZMA, NONE, ZLIB, SpectrumDecoder, SpectrumEncoder
+
+# Compression ratio and throughput of the spectrum codec on simulated data, against raw storage.
+# Qred: float32 amplitudes, Rock/Freedom: 16 bit ADC counts. A stable lamp spectrum with shot and
+# read noise and a slow intensity drift, like a long monitoring run
+PIXELS = 2048
+FRAMES = 2048
+CODECS = [
+    ('raw', NONE, None),
+    ('zlib 1', ZLIB, 1),
+    ('zlib 6', ZLIB, 6),
+    ('lzma 1', LZMA, 1),
+    ('lzma 6', LZMA, 6),
+]
+
+
+def simulate(dtype, rng):
+    pixels = np.arange(PIXELS)
+    lamp = 30000 * np.exp(-((pixels - 800) / 300.0) ** 2) + 8000 * np.exp(-((pixels - 1500) / 40.0) ** 2) + 500
+    drift = 1 + 0.01 * np.sin(np.linspace(0, 2 * np.pi, FRAMES))[:, np.newaxis]
+    signal = lamp * drift
+    frames = signal + rng.normal(0, 1, signal.shape) * np.sqrt(signal + 25)
+    if np.dtype(dtype).kind == 'f':
+        return frames.astype(dtype)
+    return np.clip(np.round(frames), 0, 65535).astype(dtype)
+
+
+def run(frames, compressor, level):
+    buf = io.BytesIO()
+    start = time.perf_counter()
+    with SpectrumEncoder(buf, PIXELS, frames.dtype, compressor, level) as encoder:
+        for i in range(0, FRAMES, 32):
+            encoder.write(frames[i:i + 32])
+    encode = time.perf_counter() - start
+    start = time.perf_counter()
+    decoded = np.concatenate(list(SpectrumDecoder(buf)))
+    decode = time.perf_counter() - start
+    if not np.array_equal(decoded, frames):
+        raise ValueError('Round trip mismatch')
+    mb = frames.nbytes / 1e6
+    return frames.nbytes / len(buf.getvalue()), mb / encode, mb / decode
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    for name, dtype in (('Qred float32', np.float32), ('Rock/Freedom uint16', np.uint16)):
+        frames = simulate(dtype, rng)
+        print('%s, %d x %d, %.1f MB' % (name, FRAMES, PIXELS, frames.nbytes / 1e6))
+        print('%-10s %8s %14s %14s' % ('codec', 'ratio', 'encode MB/s', 'decode MB/s'))
+        for label, compressor, level in CODECS:
+            ratio, encode, decode = run(frames, compressor, level)
+            print('%-10s %8.2f %14.1f %14.1f' % (label, ratio, encode, decode))
+        print()
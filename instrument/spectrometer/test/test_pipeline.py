@@ -0,0 +1,58 @@
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from instrument.spectrometer.ibsen.freedom.freedom import Spectrometer as Freedom
+from instrument.spectrometer.pipeline import CoAdd, LinearityCorrection, Pipeline, Stage
+
+
+class Scale(Stage):
+    name = 'scale'
+
+    def __init__(self, factor) -> None:
+        super().__init__()
+        self.factor = factor
+
+    def process(self, batch):
+        batch *= self.factor
+        return batch
+
+
+def test_coadd_short_batch_carries_over():
+    coadd = CoAdd(4)
+    assert coadd.process(np.ones((3, 5))).shape == (0, 5)
+    out = coadd.process(np.full((2, 5), 3.0))
+    np.testing.assert_allclose(out, [[1.5] * 5])
+
+
+def test_stage_times_keep_same_class_stages_apart():
+    pipeline = Pipeline([Scale(2), Scale(3)])
+    pipeline.process(np.ones((2, 4)))
+    assert list(pipeline.get_stage_times()) == ['scale#0', 'scale#1']
+
+
+def test_submit_cancelled_by_executor_shutdown():
+    executor = ThreadPoolExecutor(max_workers=1)
+    release = threading.Event()
+    executor.submit(release.wait)
+    pipeline = Pipeline([Scale(2)], executor=executor)
+    future = pipeline.submit(np.ones((1, 4)))
+    executor.shutdown(wait=False, cancel_futures=True)
+    release.set()
+    with pytest.raises(CancelledError):
+        future.result(timeout=5)
+
+
+def test_freedom_correction_matches_driver():
+    coeffs = {'A': 1.0, 'B1': -2e-6, 'B2': 1e-11, 'B3': 0.0, 'B4': 0.0, 'B5': 0.0, 'B6': 0.0, 'B7': 0.0}
+    raw = [100, 20000, 40000, 65000]
+    spec = Freedom.__new__(Freedom)
+    spec.linCalCoeffs = coeffs
+    spec.pixelCount = len(raw)
+    words = iter(raw)
+    spec.readDataFn = lambda count: (lambda v: bytes([v >> 8, v & 0xFF]))(next(words))
+    expected = spec.get_spectrum(use_correction=True)
+    stage = LinearityCorrection.from_freedom_coefficients(coeffs)
+    np.testing.assert_allclose(stage.process(np.array([raw], dtype=np.float64))[0], expected)
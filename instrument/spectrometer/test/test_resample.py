@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from instrument.spectrometer.resample import DENSITY, FLUX, LINEAR, Resampler
+
+
+@pytest.mark.parametrize('mode', [LINEAR, FLUX, DENSITY])
+def test_descending_source_matches_ascending(mode):
+    source = np.linspace(900, 1700, 256)
+    spectrum = np.sin(source / 50)[np.newaxis]
+    target = np.linspace(1000, 1600, 100)
+    resampler = Resampler(target, mode)
+    expected = resampler.resample(spectrum, 'asc', source)
+    mirrored = resampler.resample(spectrum[:, ::-1], 'desc', source[::-1])
+    assert not np.isnan(mirrored).any()
+    np.testing.assert_allclose(mirrored, expected)
+
+
+def test_non_monotonic_source_raises():
+    source = np.array([900.0, 1000.0, 950.0, 1100.0])
+    with pytest.raises(ValueError):
+        Resampler(np.linspace(950, 1050, 5)).resample(np.ones((1, 4)), 'x', source)
@@ -1,5 +1,4 @@
 import logging
-import serial
 import time
 from enum import Enum
 
@@ -21,7 +20,9 @@ class GPIB_Controller:
 
 	def __init__(self, port) -> None:
 		super().__init__()
-		self._port = serial.Serial(port)
+		# pyserial only gets loaded when a controller is opened
+		from serial import Serial
+		self._port = Serial(port)
 		self._port.timeout = 0.5
 		self._log = logging.getLogger('GPIB')
 